@@ -0,0 +1,94 @@
+"""Account state store: per-update CPU and memory.
+
+Compares the slotted, in-place AccountData in server.py against the previous
+approach (rebuild a dataclass per report, then asdict() + json.dumps of the
+whole fleet for every broadcast), reproduced here from the same field list.
+
+    python3 benchmarks/account_store.py --accounts 200 --rounds 20
+"""
+import argparse
+import dataclasses
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+os.environ.setdefault("MT4_ADMIN_PASS", "benchmark")
+os.environ.setdefault("MT4_TELEGRAM_ENABLED", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import server  # noqa: E402
+from common import make_report  # noqa: E402
+
+LegacyAccount = dataclasses.make_dataclass(
+    "LegacyAccount", [(name, object, dataclasses.field(default=None)) for name in server.ACCOUNT_FIELDS]
+)
+
+
+def legacy_round(store: dict, reports: list) -> int:
+    """One report per account, each followed by a full-fleet broadcast (old behaviour)."""
+    sent = 0
+    for report in reports:
+        store[report["account_name"]] = LegacyAccount(**report, last_seen=datetime.now(), status="online")
+        data = {}
+        for name, acc in store.items():
+            row = dataclasses.asdict(acc)
+            row["last_seen"] = acc.last_seen.isoformat()
+            data[name] = row
+        sent += len(json.dumps({"type": "update", "data": data, "timestamp": datetime.now().isoformat()}))
+    return sent
+
+
+def slotted_round(store: dict, reports: list) -> int:
+    """One decoded report per account updated in place, then a single coalesced patch."""
+    for report in reports:
+        account = store.get(report.account_name)
+        if account is None:
+            account = store[report.account_name] = server.AccountData(report.account_name)
+        account.update(report)
+    server.accounts = store
+    patch = server.build_patch(list(store))
+    return len(patch or "")
+
+
+def decoded_report(name: str, seq: int):
+    return server.decode_report(json.dumps(make_report(name, seq)).encode())
+
+
+def measure(label: str, fn, accounts: int, rounds: int, report=make_report):
+    names = [f"Bench-{i:04d}" for i in range(accounts)]
+    store: dict = {}
+    fn(store, [report(name, 0) for name in names])  # warm up / populate
+
+    tracemalloc.start()
+    fn({}, [report(name, 0) for name in names])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rounds_reports = [[report(name, r) for name in names] for r in range(1, rounds + 1)]
+    started = time.perf_counter()
+    sent = 0
+    for reports in rounds_reports:
+        sent += fn(store, reports)
+    elapsed = time.perf_counter() - started
+    updates = accounts * rounds
+    print(f"{label:8s} {elapsed / updates * 1e6:9.1f} us/update  "
+          f"{sent / updates / 1024:8.1f} KiB out/update  peak {peak / 1024 / 1024:6.2f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--accounts", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"accounts={args.accounts} rounds={args.rounds}")
+    measure("legacy", legacy_round, args.accounts, args.rounds)
+    measure("slotted", slotted_round, args.accounts, args.rounds, report=decoded_report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""HTTP ingest cost per cycle: one POST per account vs. one /api/data/batch request.
+
+Runs the app in-process (no network), so the numbers are the server-side cost
+of parsing, locking, history writes and broadcast wake-ups.
+
+    python3 benchmarks/batch_ingest.py --accounts 30 --cycles 50
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("MT4_ADMIN_PASS", "benchmark")
+os.environ.setdefault("MT4_TELEGRAM_ENABLED", "false")
+os.environ.setdefault("MT4_DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+os.environ.setdefault("MT4_ZMQ_BIND", "tcp://127.0.0.1:*")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import server  # noqa: E402
+from common import format_latency, make_report  # noqa: E402
+
+
+def run(label: str, client, cycles: list, send):
+    samples = []
+    for reports in cycles:
+        started = time.perf_counter()
+        send(client, reports)
+        samples.append(time.perf_counter() - started)
+    total = sum(samples)
+    print(f"{label:8s} {total / len(cycles) * 1000:7.2f} ms/cycle  "
+          f"{total / (len(cycles) * len(cycles[0])) * 1e6:7.1f} us/report  {format_latency(samples)}")
+
+
+def send_single(client, reports):
+    for body in reports:
+        client.post("/api/data", content=body)
+
+
+def send_batch(client, reports):
+    client.post("/api/data/batch", content=b"[" + b",".join(reports) + b"]")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--accounts", type=int, default=30)
+    parser.add_argument("--cycles", type=int, default=50)
+    args = parser.parse_args()
+
+    def cycles(offset):
+        return [[json.dumps(make_report(f"Bench-{i:04d}", offset + c)).encode() for i in range(args.accounts)]
+                for c in range(args.cycles)]
+
+    print(f"accounts={args.accounts} cycles={args.cycles} codec={server.json_codec}")
+    with TestClient(server.app) as client:
+        send_batch(client, cycles(0)[0])  # warm up / create accounts
+        run("single", client, cycles(0), send_single)
+        run("batch", client, cycles(args.cycles), send_batch)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Shared helpers for the benchmark scripts: EA report payloads and latency stats."""
+import random
+import time
+
+ACCOUNT_TYPES = ("LIVE", "CENT", "DEMO", "PROP_FTMO", "PROP_DARWINEX", "PROP_5ERS")
+
+
+def make_report(account_name: str, seq: int = 0, challenge_size: float = 50000) -> dict:
+    """A report with the same fields AccountMonitorEA.mq5 sends every update interval."""
+    rng = random.Random(hash((account_name, seq)))
+    balance = challenge_size * (1 + rng.uniform(-0.05, 0.08))
+    equity = balance + rng.uniform(-500, 500)
+    today_pnl = rng.uniform(-800, 800)
+    account_type = ACCOUNT_TYPES[hash(account_name) % len(ACCOUNT_TYPES)]
+    return {
+        "timestamp": int(time.time()),
+        "account_name": account_name,
+        "account_type": account_type,
+        "prop_firm": "FTMO" if account_type == "PROP_FTMO" else "",
+        "login": 10000000 + abs(hash(account_name)) % 9000000,
+        "company": "Bench Broker Ltd",
+        "server": "Bench-Server01",
+        "currency": "USD",
+        "is_cent": account_type == "CENT",
+        "is_ftmo_1step": account_type == "PROP_FTMO",
+        "balance": round(balance, 2),
+        "equity": round(equity, 2),
+        "margin": round(rng.uniform(0, 2000), 2),
+        "free_margin": round(equity - 1000, 2),
+        "profit": round(equity - balance, 2),
+        "open_profit": round(equity - balance, 2),
+        "margin_level": round(rng.uniform(500, 5000), 2),
+        "positions_count": rng.randint(0, 10),
+        "open_volume": round(rng.uniform(0, 5), 2),
+        "challenge_size": challenge_size,
+        "initial_balance": challenge_size,
+        "highest_balance": round(max(balance, challenge_size), 2),
+        "yesterday_balance": round(balance - today_pnl, 2),
+        "daily_loss_limit": challenge_size * 0.03,
+        "daily_loss_remaining": round(challenge_size * 0.03 + min(today_pnl, 0), 2),
+        "total_loss_limit": challenge_size * 0.10,
+        "total_loss_remaining": round(challenge_size * 0.10 - max(challenge_size - equity, 0), 2),
+        "profit_target_remaining": round(max(challenge_size * 1.1 - equity, 0), 2),
+        "profit_progress_pct": round(max(equity - challenge_size, 0) / (challenge_size * 0.1) * 100, 2),
+        "best_day_profit": 900.0,
+        "best_day_ratio": 35.0,
+        "best_day_remaining": 400.0,
+        "best_day_passed": True,
+        "max_daily_loss_pct": 3.0,
+        "max_total_loss_pct": 10.0,
+        "profit_target_pct": 10.0,
+        "today_pnl": round(today_pnl, 2),
+        "today_pnl_pct": round(today_pnl / balance * 100, 2),
+        "week_pnl": round(rng.uniform(-2000, 2000), 2),
+        "month_pnl": round(rng.uniform(-5000, 5000), 2),
+        "total_pnl": round(balance - challenge_size, 2),
+        "total_pnl_pct": round((balance - challenge_size) / challenge_size * 100, 2),
+        "avg_daily_pnl": 120.5,
+        "win_rate": 61.5,
+        "profitable_days": 16,
+        "losing_days": 10,
+        "max_drawdown": 1250.0,
+        "max_drawdown_pct": 2.5,
+        "sharpe_ratio": 1.42,
+        "trading_days": 26,
+        "daily_loss_alert_pct": 5.0,
+        "daily_profit_alert_pct": 0.0,
+        "update_interval": 5,
+    }
+
+
+# Fields AccountMonitorEA_HTTP.mq4 puts in its JSON report (no timestamp: the server stamps it)
+MQ4_FIELDS = (
+    "account_name", "account_type", "prop_firm", "login", "company", "server", "currency",
+    "is_cent", "is_ftmo_1step", "balance", "equity", "margin", "free_margin", "profit",
+    "open_profit", "margin_level", "positions_count", "challenge_size", "initial_balance",
+    "today_pnl", "today_pnl_pct", "total_pnl", "total_pnl_pct", "daily_loss_alert_pct",
+)
+
+
+def make_mq4_report(account_name: str, seq: int = 0, binary: bool = False) -> dict:
+    """A report as AccountMonitorEA_HTTP.mq4 sends it.
+
+    JSON carries only MQ4_FIELDS. The binary v1 layout needs every field, so the
+    ones the MQ4 EA does not track get the constants it writes (timestamp 0 = server time).
+    """
+    report = make_report(account_name, seq)
+    report["is_ftmo_1step"] = False
+    if not binary:
+        return {name: report[name] for name in MQ4_FIELDS}
+    for name, value in report.items():
+        if name not in MQ4_FIELDS:
+            report[name] = type(value)()
+    report.update(
+        timestamp=0, highest_balance=report["balance"], yesterday_balance=report["balance"],
+        max_daily_loss_pct=5.0, max_total_loss_pct=10.0, profit_target_pct=10.0,
+    )
+    return report
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def format_latency(samples) -> str:
+    """p50/p90/p99/max of latency samples given in seconds, printed in milliseconds."""
+    values = sorted(samples)
+    return "p50={:.2f}ms p90={:.2f}ms p99={:.2f}ms max={:.2f}ms".format(
+        percentile(values, 50) * 1000, percentile(values, 90) * 1000,
+        percentile(values, 99) * 1000, (values[-1] if values else 0) * 1000,
+    )
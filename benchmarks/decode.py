@@ -0,0 +1,57 @@
+"""EA payload decoding: typed schema decoder vs. the previous dict-based path, JSON vs. compact binary.
+
+    python3 benchmarks/decode.py --iterations 20000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault("MT4_ADMIN_PASS", "benchmark")
+os.environ.setdefault("MT4_TELEGRAM_ENABLED", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import server  # noqa: E402
+from common import make_report  # noqa: E402
+
+
+def legacy_decode(body: bytes) -> dict:
+    """What receive_data() + process_account_data() used to do per report."""
+    data = json.loads(body.decode().strip().split('\x00')[0])
+    values = {}
+    for name, _, default in server.REPORT_FIELDS:
+        values[name] = data[name] if default is server._REQUIRED else data.get(name, 0)
+    return values
+
+
+def bench(label: str, fn, payloads: list):
+    for payload in payloads[:100]:
+        fn(payload)
+    started = time.perf_counter()
+    for payload in payloads:
+        fn(payload)
+    elapsed = time.perf_counter() - started
+    print(f"{label:16s} {elapsed / len(payloads) * 1e6:7.2f} us/report")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    reports = [make_report(f"Bench-{i % 500:04d}", i) for i in range(args.iterations)]
+    payloads = [json.dumps(report).encode() for report in reports]
+    binary_payloads = [server.encode_binary_report(report) for report in reports]
+    print(f"payload json={len(payloads[0])} bytes binary={len(binary_payloads[0])} bytes "
+          f"iterations={args.iterations} codec={server.json_codec}")
+    bench("legacy dict", legacy_decode, payloads)
+    bench("schema (python)", server._decode_report_python, payloads)
+    if server._decode_report_msgspec is not None:
+        bench("schema (msgspec)", server._decode_report_msgspec, payloads)
+    bench("binary v%d" % server.BINARY_VERSION, server.decode_report, binary_payloads)
+
+
+if __name__ == "__main__":
+    main()
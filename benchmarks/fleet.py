@@ -0,0 +1,338 @@
+"""End-to-end load test: a simulated EA fleet (ZMQ + HTTP) and WebSocket dashboards against one server.
+
+ZMQ EAs use a REQ socket and wait for the reply like AccountMonitorEA.mq5;
+HTTP EAs POST to /api/data like AccountMonitorEA_HTTP.mq4 (keep-alive), with
+that EA's reduced field set. Every EA reports once per --interval seconds
+(0 = back-to-back). Dashboards connect to /ws and apply patches like the browser does.
+
+Reported: acknowledged reports/sec, EA-perceived reply latency, fan-out latency
+and database growth. Each report is tagged through its `margin` field; a patch
+carries the newest report of an account and covers the ones coalesced into it, so
+fan-out is measured per dashboard and account from the oldest report not yet
+seen in a patch to the patch that delivers it.
+
+    python3 benchmarks/fleet.py --spawn-server --zmq-eas 200 --http-eas 50 --dashboards 20 --seconds 20
+    python3 benchmarks/fleet.py --spawn-server --save baseline.json
+    python3 benchmarks/fleet.py --spawn-server --baseline baseline.json   # after a change
+
+Without --spawn-server it targets an already running server (--http-url, --zmq-endpoint,
+and --db to measure database growth).
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+import websockets
+import zmq
+import zmq.asyncio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import format_latency, make_mq4_report, make_report, percentile  # noqa: E402
+
+
+class Stats:
+    def __init__(self):
+        self.sent = {}  # (account_name, seq) -> 发送时刻
+        self.zmq_latency = []
+        self.http_latency = []
+        self.fanout_latency = []
+        self.errors = {"zmq": 0, "http": 0}
+        self.ws_messages = 0
+        self.ws_bytes = 0
+
+
+class Fleet:
+    """报文生成: 每个 EA 的第 seq 次上报把 seq 写进 margin, 报告时间按 --time-scale 加速"""
+
+    def __init__(self, args):
+        self.args = args
+        self.clock_start = time.time()
+        self.encode_binary = None
+        if args.format == "binary":
+            os.environ.setdefault("MT4_ADMIN_PASS", "benchmark")
+            os.environ.setdefault("MT4_TELEGRAM_ENABLED", "false")
+            sys.path.insert(0, ROOT)
+            import server
+            self.encode_binary = server.encode_binary_report
+
+    def payload(self, name: str, seq: int) -> bytes:
+        """AccountMonitorEA.mq5: 全部字段, 二进制 v2"""
+        report = make_report(name, seq)
+        report["margin"] = float(seq)
+        report["timestamp"] = int(self.clock_start + (time.time() - self.clock_start) * self.args.time_scale)
+        if self.encode_binary is not None:
+            return self.encode_binary(report, 2)
+        return json.dumps(report).encode()
+    
+    def mq4_payload(self, name: str, seq: int) -> bytes:
+        """AccountMonitorEA_HTTP.mq4: 精简字段, 不带 timestamp (服务器时间), 二进制 v1"""
+        report = make_mq4_report(name, seq, binary=self.encode_binary is not None)
+        report["margin"] = float(seq)
+        if self.encode_binary is not None:
+            return self.encode_binary(report, 1)
+        return json.dumps(report).encode()
+
+
+async def paced(args, index: int, count: int, send):
+    """按 --interval 节奏调用 send(seq), 各 EA 的起始时刻均匀错开"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + args.seconds
+    due = loop.time() + (args.interval * index / count if args.interval else 0)
+    seq = 0
+    while due < deadline:
+        await asyncio.sleep(max(0, due - loop.time()))
+        if not await send(seq):
+            return
+        seq += 1
+        due = max(due + args.interval, loop.time()) if args.interval else loop.time()
+
+
+async def zmq_ea(args, context, fleet: Fleet, stats: Stats, index: int):
+    name = f"Bench-Z{index:04d}"
+    sock = context.socket(zmq.REQ)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.connect(args.zmq_endpoint)
+
+    async def send(seq):
+        payload = fleet.payload(name, seq)
+        started = stats.sent[(name, seq)] = time.perf_counter()
+        await sock.send(payload)
+        if not await sock.poll(10000):
+            stats.errors["zmq"] += 1
+            return False
+        reply = await sock.recv()
+        stats.zmq_latency.append(time.perf_counter() - started)
+        if reply != b"OK":
+            stats.errors["zmq"] += 1
+        return True
+
+    try:
+        await paced(args, index, args.zmq_eas, send)
+    finally:
+        sock.close()
+
+
+async def http_request(reader, writer, method: str, host: str, path: str, body: bytes = b"",
+                       content_type: str = "application/json") -> tuple:
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        key, _, value = line.decode().partition(":")
+        if key.lower() == "content-length":
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def http_ea(args, fleet: Fleet, stats: Stats, index: int):
+    name = f"Bench-H{index:04d}"
+    url = urlsplit(args.http_url)
+    reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+    content_type = "application/octet-stream" if args.format == "binary" else "application/json"
+
+    async def send(seq):
+        payload = fleet.mq4_payload(name, seq)
+        started = stats.sent[(name, seq)] = time.perf_counter()
+        try:
+            status, _ = await asyncio.wait_for(
+                http_request(reader, writer, "POST", url.netloc, "/api/data", payload, content_type), 10)
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+            stats.errors["http"] += 1
+            return False
+        stats.http_latency.append(time.perf_counter() - started)
+        if status != 200:
+            stats.errors["http"] += 1
+        return True
+
+    try:
+        await paced(args, index, args.http_eas, send)
+    finally:
+        writer.close()
+
+
+async def dashboard(args, stats: Stats, stop: asyncio.Event):
+    url = urlsplit(args.http_url)
+    delivered = {}  # 账户 -> 本看板已收到的最大 seq
+    async with websockets.connect(f"ws://{url.netloc}/ws", max_size=None) as ws:
+        while not stop.is_set():
+            try:
+                raw = await asyncio.wait_for(ws.recv(), 0.5)
+            except asyncio.TimeoutError:
+                continue
+            received = time.perf_counter()
+            stats.ws_messages += 1
+            stats.ws_bytes += len(raw)
+            message = json.loads(raw)
+            if message.get("type") != "patch":
+                continue
+            for name, fields in message["changes"].items():
+                margin = fields.get("margin")
+                if margin is None:
+                    continue
+                # 合并进这个 patch 的上报中最早的一条
+                oldest = delivered.get(name, -1) + 1
+                delivered[name] = max(delivered.get(name, -1), int(margin))
+                sent = stats.sent.get((name, oldest)) if oldest <= int(margin) else None
+                if sent is not None:
+                    stats.fanout_latency.append(received - sent)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_server(args, timeout: float = 20):
+    url = urlsplit(args.http_url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            reader, writer = await asyncio.open_connection(url.hostname, url.port)
+            status, _ = await http_request(reader, writer, "GET", url.netloc, "/health")
+            writer.close()
+            if status == 200:
+                return
+        except OSError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+def database_size(path: str) -> tuple:
+    """(数据库 + WAL 字节数, history 行数)"""
+    size = sum(os.path.getsize(path + suffix) for suffix in ("", "-wal") if os.path.exists(path + suffix))
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        rows = conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+        conn.close()
+    except sqlite3.Error:
+        rows = 0
+    return size, rows
+
+
+def summarize(args, stats: Stats, elapsed: float, db_before, db_after) -> dict:
+    acked = len(stats.zmq_latency) + len(stats.http_latency)
+    result = {"ingest_per_s": acked / elapsed, "errors": sum(stats.errors.values())}
+    for label, samples in (("zmq", stats.zmq_latency), ("http", stats.http_latency),
+                           ("fanout", stats.fanout_latency)):
+        values = sorted(samples)
+        for pct in (50, 99):
+            result[f"{label}_p{pct}_ms"] = percentile(values, pct) * 1000
+    if db_before is not None:
+        result["db_growth_bytes"] = db_after[0] - db_before[0]
+        result["history_rows"] = db_after[1] - db_before[1]
+
+    print(f"zmq_eas={args.zmq_eas} http_eas={args.http_eas} dashboards={args.dashboards} "
+          f"interval={args.interval}s seconds={args.seconds} format={args.format}")
+    print(f"ingest     {result['ingest_per_s']:8.0f} reports/s  errors zmq={stats.errors['zmq']} http={stats.errors['http']}")
+    print(f"zmq reply  {format_latency(stats.zmq_latency)}")
+    print(f"http reply {format_latency(stats.http_latency)}")
+    print(f"fan-out    {format_latency(stats.fanout_latency)}  "
+          f"({stats.ws_messages / elapsed:.0f} ws msg/s, {stats.ws_bytes / elapsed / 1024:.0f} KiB/s)")
+    if db_before is not None:
+        print(f"database   +{result['db_growth_bytes'] / 1024:.0f} KiB  +{result['history_rows']} history rows")
+    return result
+
+
+def compare(result: dict, baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"vs {baseline_path}:")
+    for key, value in result.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        change = f"{(value - base) / base * 100:+.1f}%" if base else "n/a"
+        print(f"  {key:16s} {base:12.2f} -> {value:12.2f}  {change}")
+
+
+async def run(args) -> dict:
+    stats = Stats()
+    fleet = Fleet(args)
+    stop = asyncio.Event()
+    dashboards = [asyncio.create_task(dashboard(args, stats, stop)) for _ in range(args.dashboards)]
+    await asyncio.sleep(0.5)  # 先让看板收到 init
+
+    db_before = database_size(args.db) if args.db else None
+    context = zmq.asyncio.Context()
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(zmq_ea(args, context, fleet, stats, i) for i in range(args.zmq_eas)),
+        *(http_ea(args, fleet, stats, i) for i in range(args.http_eas)),
+    )
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(2)  # 等最后的广播和数据库写入
+    stop.set()
+    await asyncio.gather(*dashboards)
+    context.term()
+    db_after = database_size(args.db) if args.db else None
+    return summarize(args, stats, elapsed, db_before, db_after)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--http-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--zmq-endpoint", default="tcp://127.0.0.1:5555")
+    parser.add_argument("--db", help="server database file, to measure growth")
+    parser.add_argument("--spawn-server", action="store_true",
+                        help="start server.py with a temporary database on free ports")
+    parser.add_argument("--zmq-eas", type=int, default=200)
+    parser.add_argument("--http-eas", type=int, default=50)
+    parser.add_argument("--dashboards", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between reports per EA, 0 = back-to-back")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--format", choices=("json", "binary"), default="json")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="speed of the report clock; >1 makes the server write history rows more often")
+    parser.add_argument("--save", help="write the results as JSON")
+    parser.add_argument("--baseline", help="compare against results saved with --save")
+    args = parser.parse_args()
+
+    server = None
+    if args.spawn_server:
+        http_port, zmq_port = free_port(), free_port()
+        args.http_url = f"http://127.0.0.1:{http_port}"
+        args.zmq_endpoint = f"tcp://127.0.0.1:{zmq_port}"
+        args.db = os.path.join(tempfile.mkdtemp(), "bench.db")
+        env = dict(os.environ, MT4_ADMIN_PASS="benchmark", MT4_TELEGRAM_ENABLED="false",
+                   MT4_DB_PATH=args.db, MT4_ZMQ_BIND=args.zmq_endpoint)
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+             "--port", str(http_port), "--log-level", "warning"],
+            cwd=ROOT, env=env,
+        )
+
+    try:
+        if server is not None:
+            asyncio.run(wait_for_server(args))
+        result = asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.baseline:
+        compare(result, args.baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Ingest latency while dashboards read snapshots: global lock vs. shard locks + snapshot view.
+
+Runs in-process on one event loop. Every account reports once per --interval
+seconds, on a schedule; latency is measured from the scheduled arrival to the
+end of processing, so time the loop spends building snapshots for readers shows
+up as ingest delay. Readers poll the full account list like /api/accounts and
+/ws init do.
+
+"legacy" reproduces the previous design: one asyncio.Lock around every ingest
+and every read, and each read re-joins all accounts from live state.
+"sharded" is what server.py does now.
+
+    python3 benchmarks/lock_contention.py --accounts 1000 --readers 50 --seconds 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("MT4_ADMIN_PASS", "benchmark")
+os.environ.setdefault("MT4_TELEGRAM_ENABLED", "false")
+os.environ.setdefault("MT4_DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import server  # noqa: E402
+from common import format_latency, make_report  # noqa: E402
+
+
+def legacy_accounts_json() -> str:
+    return "{" + ",".join(acc.json_key + acc.to_json() for acc in server.accounts.values()) + "}"
+
+
+async def run(mode: str, args, reports: dict) -> None:
+    server.accounts.clear()
+    server.account_fragments.clear()
+    server.dirty_accounts.clear()
+    global_lock = asyncio.Lock()
+
+    async def ingest(report):
+        if mode == "legacy":
+            async with global_lock:
+                await server.process_account_data(report)
+        else:
+            await server.process_account_data(report)
+
+    async def read():
+        if mode == "legacy":
+            async with global_lock:
+                return legacy_accounts_json()
+        return server.snapshot_view.accounts_json()
+
+    names = list(reports)
+    for name in names:
+        await ingest(reports[name][0])
+    await server.broadcast_update()
+
+    latencies = []
+    reads = 0
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + args.seconds
+
+    async def terminal(index: int, name: str):
+        # 各终端的上报时刻均匀错开
+        due = started + args.interval * index / len(names)
+        seq = 1
+        while due < deadline:
+            await asyncio.sleep(max(0, due - loop.time()))
+            await ingest(reports[name][seq % len(reports[name])])
+            latencies.append(loop.time() - due)
+            due += args.interval
+            seq += 1
+
+    async def reader(index: int):
+        nonlocal reads
+        await asyncio.sleep(args.read_interval * index / args.readers)
+        while loop.time() < deadline:
+            await read()
+            reads += 1
+            await asyncio.sleep(args.read_interval)
+
+    broadcaster = asyncio.create_task(server.broadcast_scheduler())
+    await asyncio.gather(
+        *(terminal(i, name) for i, name in enumerate(names)),
+        *(reader(i) for i in range(args.readers)),
+    )
+    broadcaster.cancel()
+    print(f"{mode:8s} ingest {len(latencies) / args.seconds:7.0f}/s  reads {reads / args.seconds:6.0f}/s  "
+          f"{format_latency(latencies)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--readers", type=int, default=50, help="dashboards polling the account list")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between reports per account")
+    parser.add_argument("--read-interval", type=float, default=0.5, help="seconds between polls per reader")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    server.init_database()
+    server.db_writer.start()
+    reports = {
+        f"Bench-{i:04d}": [server.decode_report(json.dumps(make_report(f"Bench-{i:04d}", seq)).encode())
+                           for seq in range(4)]
+        for i in range(args.accounts)
+    }
+    print(f"accounts={args.accounts} readers={args.readers} interval={args.interval}s "
+          f"read_interval={args.read_interval}s codec={server.json_codec}")
+
+    async def both():
+        # server 的锁和事件绑定在第一次使用它们的事件循环上, 两种模式需在同一个循环中运行
+        for mode in ("legacy", "sharded"):
+            await run(mode, args, reports)
+
+    asyncio.run(both())
+    server.db_writer.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Risk rule evaluation cost as the number of rules grows: full re-evaluation vs. threshold index.
+
+Adds N synthetic threshold rules over the numeric report fields to the DEFAULT
+rule set and replays a stream of reports where only the fields a live account
+actually moves between updates change (equity, profit, PnL, loss headroom...).
+
+    python3 benchmarks/risk_rules.py --reports 20000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("MT4_ADMIN_PASS", "benchmark")
+os.environ.setdefault("MT4_TELEGRAM_ENABLED", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import server  # noqa: E402
+from common import make_report  # noqa: E402
+
+# 两次上报之间会变化的字段及每次的最大变动
+MOVING_FIELDS = {
+    "equity": 150, "profit": 150, "open_profit": 150, "margin": 50, "free_margin": 150,
+    "margin_level": 80, "today_pnl": 150, "today_pnl_pct": 0.3, "daily_loss_remaining": 150,
+    "total_loss_remaining": 150, "profit_progress_pct": 2, "total_pnl": 150, "total_pnl_pct": 0.3,
+}
+
+
+class BenchAccount(server.AccountData):
+    """Without __slots__, so synthetic rules can keep their state as attributes."""
+
+
+def synthetic_rules(count: int, base: dict, rng: random.Random) -> dict:
+    numeric = [name for name, ftype, _ in server.REPORT_FIELDS if ftype is float]
+    rules = {}
+    for index in range(count):
+        metric = rng.choice(numeric)
+        center = base[metric] or 1.0
+        rules[f"bench_rule_{index}"] = {
+            "levels": [
+                {"state": "danger", "when": f"{metric} <= {center * rng.uniform(0.5, 0.9):.4f}",
+                 "alert": ("Bench", "{value}", "info")},
+                {"state": "warning", "when": f"{metric} <= {center * rng.uniform(0.9, 1.1):.4f}"},
+            ],
+            "otherwise": "safe",
+            "hysteresis": abs(center) * 0.01,
+        }
+    return rules
+
+
+def report_stream(base: dict, count: int, rng: random.Random) -> list:
+    reports, current = [], dict(base)
+    for seq in range(count):
+        current["timestamp"] = base["timestamp"] + seq * 5
+        for name, step in MOVING_FIELDS.items():
+            current[name] = round(current[name] + rng.uniform(-step, step), 2)
+        reports.append(server.decode_report(json.dumps(current).encode()))
+    return reports
+
+
+def full_evaluate(account, changed):
+    """Reference: evaluate every rule of the account's rule set on every report."""
+    rule_set = server.rule_set_for(account)
+    account.rules = rule_set
+    for rule in rule_set.rules:
+        result = rule.evaluate(account)
+        if result is not None:
+            account.set(rule.field, result[0])
+
+
+def measure(evaluate, reports: list, specs: dict) -> float:
+    account = BenchAccount(reports[0].account_name)
+    for field in specs:
+        setattr(account, field, specs[field]["otherwise"])
+    account.update(reports[0])
+    server.evaluate_risk(account, ())
+
+    started = time.perf_counter()
+    for report in reports:
+        evaluate(account, account.update(report))
+    return (time.perf_counter() - started) / len(reports) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reports", type=int, default=20000)
+    parser.add_argument("--rules", default="0,40,400,4000", help="synthetic rule counts")
+    args = parser.parse_args()
+
+    server.notify = lambda *args, **kwargs: None
+    rng = random.Random(7)
+    base = make_report("Bench-0001")
+    base["account_type"] = "LIVE"
+    base["is_ftmo_1step"] = False
+    reports = report_stream(base, args.reports, rng)
+    default_rules = dict(server.RULE_SETS["DEFAULT"])
+
+    print(f"reports={args.reports} moving_fields={len(MOVING_FIELDS)}")
+    for count in (int(value) for value in args.rules.split(",")):
+        specs = dict(default_rules, **synthetic_rules(count, base, rng))
+        server.COMPILED_RULE_SETS["DEFAULT"] = server.CompiledRuleSet("DEFAULT", specs)
+        full = measure(full_evaluate, reports, specs)
+        indexed = measure(server.evaluate_risk, reports, specs)
+        print(f"rules={len(specs):5d}  full {full:8.2f} us/report  indexed {indexed:6.2f} us/report")
+
+
+if __name__ == "__main__":
+    main()
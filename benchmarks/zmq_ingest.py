@@ -0,0 +1,67 @@
+"""ZMQ ingest throughput at fleet scale.
+
+Opens N REQ sockets (the same socket type AccountMonitorEA.mq5 uses) against a
+running server and has every simulated terminal send reports back-to-back,
+measuring messages/sec and the EA-perceived reply latency.
+
+    MT4_ADMIN_PASS=x MT4_DB_PATH=/tmp/bench.db python3 server.py &
+    python3 benchmarks/zmq_ingest.py --terminals 500 --messages 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import zmq
+import zmq.asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import format_latency, make_report  # noqa: E402
+
+
+async def terminal(context, endpoint: str, name: str, messages: int, latencies: list, errors: list):
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(endpoint)
+    try:
+        for seq in range(messages):
+            payload = json.dumps(make_report(name, seq)).encode()
+            started = time.perf_counter()
+            await socket.send(payload)
+            if not await socket.poll(10000):
+                errors.append("timeout")
+                return
+            reply = await socket.recv()
+            latencies.append(time.perf_counter() - started)
+            if reply != b"OK":
+                errors.append(reply)
+    finally:
+        socket.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--endpoint", default="tcp://127.0.0.1:5555")
+    parser.add_argument("--terminals", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=20, help="reports per terminal")
+    args = parser.parse_args()
+
+    context = zmq.asyncio.Context()
+    latencies, errors = [], []
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        terminal(context, args.endpoint, f"Bench-{i:04d}", args.messages, latencies, errors)
+        for i in range(args.terminals)
+    ))
+    elapsed = time.perf_counter() - started
+    context.term()
+
+    print(f"terminals={args.terminals} messages={len(latencies)} errors={len(errors)} elapsed={elapsed:.2f}s")
+    print(f"throughput={len(latencies) / elapsed:.0f} msg/s")
+    print(f"reply latency {format_latency(latencies)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
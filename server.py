@@ -1,22 +1,37 @@
 # Fix for Windows Python 3.12 + zmq compatibility - MUST be before importing zmq
 import sys
 import asyncio
+import bisect
+import contextlib
 if sys.platform == 'win32':
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, status, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from pydantic import BaseModel
 import zmq.asyncio
 import json
 import sqlite3
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
-from dataclasses import dataclass, asdict
+from typing import Dict, Iterable, List, Optional, Set
+import heapq
+import math
+import operator
+import struct
+from collections import deque
 import uvicorn
 import secrets
 import os
+import time
+import queue
+import threading
+import csv
+import io
+from concurrent.futures import ThreadPoolExecutor
+import traceback
+import urllib.request
+from pathlib import Path
 
 #--- 配置 ---
 # 从环境变量读取，如果不存在则用默认值
@@ -27,6 +42,34 @@ if not ADMIN_PASSWORD:
 ENABLE_AUTH = os.getenv("MT4_ENABLE_AUTH", "true").lower() == "true"
 TELEGRAM_ENABLED = os.getenv("MT4_TELEGRAM_ENABLED", "true").lower() == "true"
 TELEGRAM_CHAT_ID = os.getenv("MT4_TELEGRAM_CHAT_ID", "6692882496")  # 你的Telegram ID
+BROADCAST_HZ = float(os.getenv("MT4_BROADCAST_HZ", "4"))  # WebSocket 每秒最多广播次数
+WS_QUEUE_SIZE = int(os.getenv("MT4_WS_QUEUE_SIZE", "16"))  # 每个客户端最多积压的消息数
+WS_MAX_LAG = float(os.getenv("MT4_WS_MAX_LAG", "30"))  # 客户端积压超过该秒数则断开
+DB_PATH = os.getenv("MT4_DB_PATH", "mt4_monitor.db")
+HISTORY_SAVE_INTERVAL = 300  # 同一账户历史记录最小间隔 (秒)
+DB_BATCH_SIZE = int(os.getenv("MT4_DB_BATCH_SIZE", "200"))  # 每批最多提交的写入数
+DB_FLUSH_INTERVAL = float(os.getenv("MT4_DB_FLUSH_INTERVAL", "1.0"))  # 每批最长等待秒数
+DB_LOCK_TIMEOUT = 10  # 数据库被占用时最长等待秒数
+ROLLUP_INTERVAL = float(os.getenv("MT4_ROLLUP_INTERVAL", "600"))  # 汇总任务间隔 (秒)
+RAW_RETENTION_DAYS = int(os.getenv("MT4_RAW_RETENTION_DAYS", "0"))  # 原始 history 保留天数, 0=永久
+HOURLY_RETENTION_DAYS = int(os.getenv("MT4_HOURLY_RETENTION_DAYS", "730"))  # 小时汇总保留天数, 0=永久
+JSON_CODEC = os.getenv("MT4_JSON_CODEC", "auto")  # auto / orjson / msgspec / stdlib
+ZMQ_BIND = os.getenv("MT4_ZMQ_BIND", "tcp://0.0.0.0:5555")
+INGEST_WORKERS = int(os.getenv("MT4_INGEST_WORKERS", "4"))  # 异步处理 EA 数据的工作协程数
+INGEST_QUEUE_SIZE = int(os.getenv("MT4_INGEST_QUEUE_SIZE", "10000"))  # 每个工作协程的待处理上限
+NOTIFY_QUEUE_SIZE = int(os.getenv("MT4_NOTIFY_QUEUE_SIZE", "1000"))  # 满时丢弃最旧的通知
+NOTIFY_COALESCE_SECONDS = float(os.getenv("MT4_NOTIFY_COALESCE_SECONDS", "2"))  # 同一账户在此窗口内的告警合并为一条
+NOTIFY_MAX_RETRIES = int(os.getenv("MT4_NOTIFY_MAX_RETRIES", "5"))  # 指数退避重试次数
+NOTIFY_SENDERS = int(os.getenv("MT4_NOTIFY_SENDERS", "2"))  # 同时发送 (含重试中) 的通知数
+NOTIFY_WEBHOOK_URL = os.getenv("MT4_NOTIFY_WEBHOOK_URL")  # 可选: 改为 POST 到该地址 (Telegram Bot API 或本地测试桩)
+OFFLINE_MISSED_REPORTS = float(os.getenv("MT4_OFFLINE_MISSED_REPORTS", "3"))  # 连续错过几次上报判定离线
+OFFLINE_TIMEOUT = float(os.getenv("MT4_OFFLINE_TIMEOUT", "60"))  # EA 未上报 update_interval 时的离线判定秒数
+SLOW_INGEST_MS = float(os.getenv("MT4_SLOW_INGEST_MS", "1000"))  # 上报到广播超过该毫秒数时记录各阶段耗时, 0=关闭
+PROFILE_MAX_SECONDS = 300  # 采样分析器单次最长运行时间
+LOOP_LAG_MS = float(os.getenv("MT4_LOOP_LAG_MS", "250"))  # 事件循环被阻塞超过该毫秒数时打印其调用栈, 0=关闭
+LOOP_HEARTBEAT_INTERVAL = 0.1  # 事件循环心跳间隔 (秒)
+DB_READERS = int(os.getenv("MT4_DB_READERS", "4"))  # 同时执行的历史/统计查询数 (只读连接池大小)
+DB_QUERY_TIMEOUT = float(os.getenv("MT4_DB_QUERY_TIMEOUT", "10"))  # 单次查询 (含排队) 最长秒数, 超时中止查询
 
 #--- 安全设置 ---
 security = HTTPBasic()
@@ -46,95 +89,793 @@ def verify_credentials(credentials: HTTPBasicCredentials = Depends(security)):
         )
     return credentials
 
+#--- JSON 编解码 ---
+# 优先使用 orjson / msgspec, 都未安装时退回标准库
+def _select_json_codec():
+    candidates = ("orjson", "msgspec") if JSON_CODEC == "auto" else (JSON_CODEC,)
+    for name in candidates:
+        try:
+            if name == "orjson":
+                import orjson
+                return name, orjson.dumps, orjson.loads
+            if name == "msgspec":
+                import msgspec
+                return name, msgspec.json.Encoder().encode, msgspec.json.Decoder().decode
+        except ImportError:
+            continue
+    return "stdlib", None, json.loads
+
+json_codec, _fast_dumps, json_loads = _select_json_codec()
+_encode_str = json.encoder.encode_basestring_ascii
+_json_keys: Dict[str, str] = {}
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def json_dumps(obj) -> str:
+    if _fast_dumps is not None:
+        return _fast_dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"), default=_json_default)
+
+def json_key(name: str) -> str:
+    """'"name":' 前缀, 按名字缓存"""
+    key = _json_keys.get(name)
+    if key is None:
+        key = _json_keys[name] = _encode_str(name) + ":"
+    return key
+
+def encode_json_value(value) -> str:
+    """标准库路径: 与 json.dumps 输出一致的标量编码"""
+    if value is None:
+        return "null"
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    cls = type(value)
+    if cls is float:
+        return float.__repr__(value) if math.isfinite(value) else json.dumps(value)
+    if cls is int:
+        return int.__repr__(value)
+    if cls is str:
+        return _encode_str(value)
+    if cls is datetime:
+        return '"' + value.isoformat() + '"'
+    return json.dumps(value, default=_json_default)
+
+def encode_fields(obj, fields: Iterable[str]) -> str:
+    """把对象的指定属性编码为 JSON 对象"""
+    if _fast_dumps is not None:
+        return _fast_dumps({name: getattr(obj, name) for name in fields}).decode()
+    return "{" + ",".join(json_key(name) + encode_json_value(getattr(obj, name)) for name in fields) + "}"
+
 #--- 数据模型 ---
-@dataclass
-class AccountData:
-    timestamp: int
-    account_name: str
-    account_type: str
-    prop_firm: str
-    login: int
-    company: str
-    server: str
-    currency: str
-    is_cent: bool
-    is_ftmo_1step: bool
-    balance: float
-    equity: float
-    margin: float
-    free_margin: float
-    profit: float
-    open_profit: float
-    margin_level: float
-    positions_count: int
-    open_volume: float
-    challenge_size: float
-    initial_balance: float
-    highest_balance: float
-    yesterday_balance: float
-    daily_loss_limit: float
-    daily_loss_remaining: float
-    total_loss_limit: float
-    total_loss_remaining: float
-    profit_target_remaining: float
-    profit_progress_pct: float
-    best_day_profit: float
-    best_day_ratio: float
-    best_day_remaining: float
-    best_day_passed: bool
-    max_daily_loss_pct: float
-    max_total_loss_pct: float
-    profit_target_pct: float
+_REQUIRED = object()  # 必填字段
+_BALANCE = object()   # 缺省取 balance
+_NOW = object()       # 缺省取服务器当前时间
+_SENTINELS = (_REQUIRED, _BALANCE, _NOW)
+
+# EA 上报字段: (字段名, 缺省值)
+REPORT_FIELDS = (
+    ('timestamp', int, _NOW),
+    ('account_name', str, _REQUIRED),
+    ('account_type', str, _REQUIRED),
+    ('prop_firm', str, ''),
+    ('login', int, _REQUIRED),
+    ('company', str, _REQUIRED),
+    ('server', str, _REQUIRED),
+    ('currency', str, _REQUIRED),
+    ('is_cent', bool, _REQUIRED),
+    ('is_ftmo_1step', bool, False),
+    ('balance', float, _REQUIRED),
+    ('equity', float, _REQUIRED),
+    ('margin', float, _REQUIRED),
+    ('free_margin', float, _REQUIRED),
+    ('profit', float, _REQUIRED),
+    ('open_profit', float, _REQUIRED),
+    ('margin_level', float, _REQUIRED),
+    ('positions_count', int, _REQUIRED),
+    ('open_volume', float, 0),
+    ('challenge_size', float, _REQUIRED),
+    ('initial_balance', float, _BALANCE),
+    ('highest_balance', float, _BALANCE),
+    ('yesterday_balance', float, _BALANCE),
+    ('daily_loss_limit', float, 0),
+    ('daily_loss_remaining', float, 0),
+    ('total_loss_limit', float, 0),
+    ('total_loss_remaining', float, 0),
+    ('profit_target_remaining', float, 0),
+    ('profit_progress_pct', float, 0),
+    ('best_day_profit', float, 0),
+    ('best_day_ratio', float, 0),
+    ('best_day_remaining', float, 0),
+    ('best_day_passed', bool, False),
+    ('max_daily_loss_pct', float, 5),
+    ('max_total_loss_pct', float, 10),
+    ('profit_target_pct', float, 10),
     
     # PnL 统计
-    today_pnl: float = 0
-    today_pnl_pct: float = 0
-    week_pnl: float = 0
-    month_pnl: float = 0
-    total_pnl: float = 0
-    total_pnl_pct: float = 0
-    avg_daily_pnl: float = 0
-    win_rate: float = 0
-    profitable_days: int = 0
-    losing_days: int = 0
-    max_drawdown: float = 0
-    max_drawdown_pct: float = 0
-    sharpe_ratio: float = 0
-    trading_days: int = 0
-    daily_loss_alert_pct: float = 5
-    daily_profit_alert_pct: float = 0
-    
+    ('today_pnl', float, 0),
+    ('today_pnl_pct', float, 0),
+    ('week_pnl', float, 0),
+    ('month_pnl', float, 0),
+    ('total_pnl', float, 0),
+    ('total_pnl_pct', float, 0),
+    ('avg_daily_pnl', float, 0),
+    ('win_rate', float, 0),
+    ('profitable_days', int, 0),
+    ('losing_days', int, 0),
+    ('max_drawdown', float, 0),
+    ('max_drawdown_pct', float, 0),
+    ('sharpe_ratio', float, 0),
+    ('trading_days', int, 0),
+    ('daily_loss_alert_pct', float, 5),
+    ('daily_profit_alert_pct', float, 0),
+    ('update_interval', int, 0),  # EA 上报间隔 (秒), 0=未知
+)
+
+# 服务器维护的字段
+RUNTIME_FIELDS = (
     # 运行时
-    last_seen: Optional[datetime] = None
-    status: str = "online"
+    ('last_seen', None),
+    ('status', "online"),
     
     # 风险状态
-    daily_loss_risk: str = "safe"
-    total_loss_risk: str = "safe"
-    profit_target_risk: str = "pending"
-    pnl_alert_triggered: bool = False
-    alert_sent: bool = False  # 用于防止重复发送
-
-    def to_dict(self):
-        data = asdict(self)
-        if self.last_seen:
-            data['last_seen'] = self.last_seen.isoformat()
-        return data
+    ('daily_loss_risk', "safe"),
+    ('total_loss_risk', "safe"),
+    ('profit_target_risk', "pending"),
+    ('pnl_alert_triggered', False),
+)
+
+REPORT_FIELD_NAMES = tuple(name for name, _, _ in REPORT_FIELDS)
+ACCOUNT_FIELDS = REPORT_FIELD_NAMES + tuple(name for name, _ in RUNTIME_FIELDS)
+
+class AccountData:
+    """单个账户的状态: __slots__ 记录, 每次上报原地更新
+    
+    changed 记录自上次广播以来变化的字段, 增量推送只编码这些字段;
+    version 在每次变化时递增, 完整 JSON 按 version 缓存, 快照直接拼接缓存片段。
+    """
+    
+    __slots__ = ACCOUNT_FIELDS + ('changed', 'version', 'json_key', '_json', '_json_version', 'rules', 'risk_metrics')
+    
+    def __init__(self, account_name: str):
+        for name, _, default in REPORT_FIELDS:
+            setattr(self, name, None if default in _SENTINELS else default)
+        for name, default in RUNTIME_FIELDS:
+            setattr(self, name, default)
+        self.account_name = account_name
+        self.changed: Set[str] = set(ACCOUNT_FIELDS)
+        self.version = 0
+        self.json_key = json_key(account_name)
+        self._json: Optional[str] = None
+        self._json_version = -1
+        self.rules = None  # 当前使用的 CompiledRuleSet
+        self.risk_metrics: Dict[str, Optional[float]] = {}  # 规则指标上次求值的结果
+    
+    def update(self, report: "AccountReport") -> List[str]:
+        """用一份解码后的 EA 上报覆盖全部上报字段, 并标记为在线; 返回本次变化的上报字段"""
+        changed = []
+        for name in REPORT_FIELD_NAMES:
+            value = getattr(report, name)
+            if getattr(self, name) != value:
+                setattr(self, name, value)
+                changed.append(name)
+        self.changed.update(changed)
+        self.last_seen = datetime.now()
+        self.changed.add('last_seen')
+        self.version += 1
+        self.set('status', "online")
+        return changed
+    
+    def set(self, name: str, value):
+        """修改字段并记录变化"""
+        if getattr(self, name) != value:
+            setattr(self, name, value)
+            self.changed.add(name)
+            self.version += 1
+    
+    def mark_changed(self, fields: Iterable[str]):
+        self.changed.update(fields)
+        self.version += 1
+    
+    def to_json(self, fields: Optional[Iterable[str]] = None) -> str:
+        """编码指定字段为 JSON 对象; 不指定时返回按 version 缓存的完整记录"""
+        if fields is not None:
+            return encode_fields(self, fields)
+        if self._json_version != self.version:
+            self._json = encode_fields(self, ACCOUNT_FIELDS)
+            self._json_version = self.version
+        return self._json
+
+#--- EA 数据解码 ---
+# 按 REPORT_FIELDS 一次性把字节解码为带类型的 AccountReport;
+# 安装了 msgspec 时由其直接解码为 Struct, 否则使用等价的纯 Python 实现
+class PayloadError(ValueError):
+    """EA 数据不合法; kind 为 decode (不是合法 JSON) 或 schema (字段缺失/类型错误)"""
+    
+    def __init__(self, kind: str, message: str):
+        super().__init__(message)
+        self.kind = kind
+
+class UnsupportedBinaryVersion(PayloadError):
+    """二进制报告的版本服务器不认识; ZMQ 回复 ERROR UNSUPPORTED, EA 据此改用 JSON"""
+    
+    def __init__(self, version: int):
+        super().__init__("schema", f"Unsupported binary report version {version}")
+
+_BALANCE_FIELDS = tuple(name for name, _, default in REPORT_FIELDS if default is _BALANCE)
+
+def _report_defaults(report):
+    """补全依赖其它字段或当前时间的缺省值"""
+    if report.timestamp is None:
+        report.timestamp = int(time.time())
+    for name in _BALANCE_FIELDS:
+        if getattr(report, name) is None:
+            setattr(report, name, report.balance)
+    return report
+
+class AccountReport:
+    """纯 Python 解码结果, 字段与 msgspec Struct 相同"""
+    
+    __slots__ = REPORT_FIELD_NAMES
+
+def _check_float(value):
+    if type(value) is float:
+        return value
+    if type(value) is int:
+        return float(value)
+    raise TypeError
+
+def _check_exact(ftype):
+    def check(value):
+        if type(value) is not ftype:
+            raise TypeError
+        return value
+    return check
+
+_FIELD_CHECKS = {float: _check_float, int: _check_exact(int), bool: _check_exact(bool), str: _check_exact(str)}
+_COMPILED_FIELDS = tuple(
+    (name, _FIELD_CHECKS[ftype], ftype.__name__, default) for name, ftype, default in REPORT_FIELDS
+)
+_MISSING = object()
+
+def _decode_json(payload: bytes):
+    try:
+        return json_loads(payload)
+    except ValueError as e:
+        raise PayloadError("decode", str(e))
+
+def _build_report(data) -> AccountReport:
+    """按 REPORT_FIELDS 校验一个已解析的 JSON 对象"""
+    if not isinstance(data, dict):
+        raise PayloadError("schema", "Expected `object`")
+    
+    report = AccountReport()
+    for name, check, type_name, default in _COMPILED_FIELDS:
+        value = data.get(name, _MISSING)
+        if value is _MISSING:
+            if default is _REQUIRED:
+                raise PayloadError("schema", f"Object missing required field `{name}`")
+            value = None if default is _BALANCE or default is _NOW else default
+        elif value is not None or default not in (_BALANCE, _NOW):
+            try:
+                value = check(value)
+            except TypeError:
+                raise PayloadError("schema", f"Expected `{type_name}`, got `{type(value).__name__}` - at `$.{name}`")
+        setattr(report, name, value)
+    return _report_defaults(report)
+
+def _decode_report_python(payload: bytes) -> AccountReport:
+    return _build_report(_decode_json(payload))
+
+def _decode_report_batch_python(payload: bytes) -> list:
+    items = _decode_json(payload)
+    if not isinstance(items, list):
+        raise PayloadError("schema", "Expected `array`")
+    results = []
+    for item in items:
+        try:
+            results.append(_build_report(item))
+        except PayloadError as e:
+            results.append(e)
+    return results
+
+def _build_msgspec_decoders():
+    try:
+        import msgspec
+    except ImportError:
+        return None, None
+    
+    fields = []
+    for name, ftype, default in REPORT_FIELDS:
+        if default is _REQUIRED:
+            fields.append((name, ftype))
+        elif default is _BALANCE or default is _NOW:
+            fields.append((name, Optional[ftype], None))
+        else:
+            fields.append((name, ftype, default))
+    schema = msgspec.defstruct("AccountReport", fields, kw_only=True)
+    decoder = msgspec.json.Decoder(schema)
+    # 批量时先只切分数组, 每个元素单独校验, 一条不合法不影响其它
+    batch_decoder = msgspec.json.Decoder(List[msgspec.Raw])
+    
+    def decode(payload: bytes):
+        try:
+            return _report_defaults(decoder.decode(payload))
+        except msgspec.ValidationError as e:
+            raise PayloadError("schema", str(e))
+        except msgspec.DecodeError as e:
+            raise PayloadError("decode", str(e))
+    
+    def decode_batch(payload: bytes) -> list:
+        try:
+            items = batch_decoder.decode(payload)
+        except msgspec.ValidationError as e:
+            raise PayloadError("schema", str(e))
+        except msgspec.DecodeError as e:
+            raise PayloadError("decode", str(e))
+        results = []
+        for item in items:
+            try:
+                results.append(decode(item))
+            except PayloadError as e:
+                results.append(e)
+        return results
+    
+    return decode, decode_batch
+
+_decode_report_msgspec, _decode_report_batch_msgspec = _build_msgspec_decoders()
+_decode_report_json = _decode_report_msgspec or _decode_report_python
+# 批量上报 (JSON 数组): 返回与输入一一对应的 AccountReport 或 PayloadError
+decode_report_batch = _decode_report_batch_msgspec or _decode_report_batch_python
+
+#--- EA 紧凑二进制格式 ---
+# b"MTR" + 版本号(1字节) + 数值区(小端定长, q=int64 i=int32 d=double ?=bool) + 字符串区(1字节长度 + UTF-8)
+# 已发布的版本布局不可修改, 新增字段只能追加新版本; 服务器不认识的版本返回 schema 错误 (ZMQ 回复 ERROR UNSUPPORTED), EA 据此改用 JSON
+# timestamp 为 0 时由服务器取当前时间 (EA 不上报 UTC 时间时使用, 避免混入经纪商时区)
+BINARY_MAGIC = b"MTR"
+BINARY_SCHEMAS = {
+    1: (
+        ('timestamp', 'q'), ('login', 'q'), ('is_cent', '?'), ('is_ftmo_1step', '?'),
+        ('balance', 'd'), ('equity', 'd'), ('margin', 'd'), ('free_margin', 'd'),
+        ('profit', 'd'), ('open_profit', 'd'), ('margin_level', 'd'), ('positions_count', 'i'),
+        ('open_volume', 'd'), ('challenge_size', 'd'), ('initial_balance', 'd'),
+        ('highest_balance', 'd'), ('yesterday_balance', 'd'), ('daily_loss_limit', 'd'),
+        ('daily_loss_remaining', 'd'), ('total_loss_limit', 'd'), ('total_loss_remaining', 'd'),
+        ('profit_target_remaining', 'd'), ('profit_progress_pct', 'd'), ('best_day_profit', 'd'),
+        ('best_day_ratio', 'd'), ('best_day_remaining', 'd'), ('best_day_passed', '?'),
+        ('max_daily_loss_pct', 'd'), ('max_total_loss_pct', 'd'), ('profit_target_pct', 'd'),
+        ('today_pnl', 'd'), ('today_pnl_pct', 'd'), ('week_pnl', 'd'), ('month_pnl', 'd'),
+        ('total_pnl', 'd'), ('total_pnl_pct', 'd'), ('avg_daily_pnl', 'd'), ('win_rate', 'd'),
+        ('profitable_days', 'i'), ('losing_days', 'i'), ('max_drawdown', 'd'),
+        ('max_drawdown_pct', 'd'), ('sharpe_ratio', 'd'), ('trading_days', 'i'),
+        ('daily_loss_alert_pct', 'd'), ('daily_profit_alert_pct', 'd'),
+        ('account_name', 's'), ('account_type', 's'), ('prop_firm', 's'),
+        ('company', 's'), ('server', 's'), ('currency', 's'),
+    ),
+}
+# v2: v1 + update_interval
+BINARY_SCHEMAS[2] = (
+    tuple(field for field in BINARY_SCHEMAS[1] if field[1] != 's')
+    + (('update_interval', 'i'),)
+    + tuple(field for field in BINARY_SCHEMAS[1] if field[1] == 's')
+)
+BINARY_VERSION = max(BINARY_SCHEMAS)
+
+def _compile_assign(names):
+    """生成 report.a, report.b, ... = values 形式的批量赋值函数, 比逐个 setattr 快数倍"""
+    namespace = {}
+    exec(f"def assign(report, values):\n    {', '.join('report.' + name for name in names)}, = values\n", namespace)
+    return namespace['assign']
+
+class _BinaryLayout:
+    """某个版本的预编译布局"""
+    
+    def __init__(self, fields):
+        self.numeric = tuple(name for name, code in fields if code != 's')
+        self.struct = struct.Struct('<' + ''.join(code for _, code in fields if code != 's'))
+        self.strings = tuple(name for name, code in fields if code == 's')
+        self.assign_numeric = _compile_assign(self.numeric)
+        self.assign_strings = _compile_assign(self.strings)
+        names = {name for name, _ in fields}
+        # 该版本没有的字段按 JSON 缺省值处理
+        self.missing = tuple(
+            (name, None if default is _BALANCE or default is _NOW else default)
+            for name, _, default in REPORT_FIELDS if name not in names
+        )
+
+_BINARY_LAYOUTS = {version: _BinaryLayout(fields) for version, fields in BINARY_SCHEMAS.items()}
+
+def _decode_report_binary(payload: bytes) -> AccountReport:
+    if len(payload) < 4:
+        raise PayloadError("decode", "Truncated binary header")
+    layout = _BINARY_LAYOUTS.get(payload[3])
+    if layout is None:
+        raise UnsupportedBinaryVersion(payload[3])
+    
+    try:
+        values = layout.struct.unpack_from(payload, 4)
+    except struct.error as e:
+        raise PayloadError("decode", str(e))
+    report = AccountReport()
+    layout.assign_numeric(report, values)
+    
+    strings = []
+    offset = 4 + layout.struct.size
+    size = len(payload)
+    for name in layout.strings:
+        end = offset + 1 + payload[offset] if offset < size else size + 1
+        if end > size:
+            raise PayloadError("decode", f"Truncated binary report - at `{name}`")
+        try:
+            strings.append(payload[offset + 1:end].decode('utf-8'))
+        except UnicodeDecodeError as e:
+            raise PayloadError("decode", f"{e} - at `{name}`")
+        offset = end
+    layout.assign_strings(report, strings)
+    
+    for name, default in layout.missing:
+        setattr(report, name, default)
+    if report.timestamp == 0:
+        report.timestamp = None  # 0 = 与 JSON 缺省一致, 取服务器时间
+    return _report_defaults(report)
+
+def encode_binary_report(data: dict, version: int = BINARY_VERSION) -> bytes:
+    """把 EA 字段字典编码为二进制格式 (供压测和调试使用)"""
+    layout = _BINARY_LAYOUTS[version]
+    parts = [BINARY_MAGIC, bytes((version,)), layout.struct.pack(*(data[name] for name in layout.numeric))]
+    for name in layout.strings:
+        raw = data[name].encode('utf-8')
+        if len(raw) > 255:
+            raise ValueError(f"{name} longer than 255 bytes")
+        parts.append(bytes((len(raw),)))
+        parts.append(raw)
+    return b"".join(parts)
+
+def decode_report(payload: bytes):
+    """按前缀识别格式: 二进制 (MTR) 或 JSON"""
+    if payload[:3] == BINARY_MAGIC:
+        return _decode_report_binary(payload)
+    # MQL 的 StringToCharArray 会带上结尾的 \x00
+    return _decode_report_json(payload.split(b'\x00', 1)[0].strip())
+
+#--- 运行指标 ---
+# Prometheus 文本格式 (/metrics); 热路径上只有 perf_counter + 字典累加, 可以在生产环境常开
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS: List["Metric"] = []
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = ['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    """一个指标族; labels 为标签名, 每组标签值 (tuple) 对应一个序列
+
+    fn 不为空时在抓取时调用, 返回数值或 {标签值: 数值}, 用于直接读取已有的计数/队列长度。
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), fn=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.fn = fn
+        self.values: Dict[tuple, float] = {}
+        METRICS.append(self)
+
+    def render(self, lines: List[str]):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        values = self.values if self.fn is None else self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, labels: tuple = ()):
+        self.values[labels] = value
+
+class Histogram(Metric):
+    """每个序列为 [各桶计数..., 超出最大桶的计数, 总和]; 输出时再累加为 le 桶"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        self.series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, labels: tuple = ()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self, lines: List[str]):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} histogram")
+        for key, series in list(self.series.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {total}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {total}")
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for metric in METRICS:
+        metric.render(lines)
+    return "\n".join(lines) + "\n"
+
+def _client_queue_stats() -> Dict[tuple, float]:
+    depths = [client.queue.qsize() for client in active_connections]
+    return {("total",): sum(depths), ("max",): max(depths, default=0)}
+
+INGEST_REPORTS = Counter("mt4_ingest_reports_total", "EA reports accepted", ("source",))
+INGEST_ERRORS = Counter("mt4_ingest_errors_total", "EA reports rejected", ("source", "kind"))
+PROCESS_SECONDS = Histogram("mt4_process_seconds", "process_account_batch duration (one report = batch of 1)")
+LOCK_WAIT_SECONDS = Histogram("mt4_account_lock_wait_seconds", "Time spent waiting for account shard locks")
+DB_FLUSH_SECONDS = Histogram("mt4_db_flush_seconds", "Database writer: execute + commit of one batch")
+DB_BATCH_JOBS = Histogram("mt4_db_batch_jobs", "Jobs per database commit", (1, 5, 10, 25, 50, 100, 200, 500, 1000))
+BROADCAST_BUILD_SECONDS = Histogram("mt4_broadcast_build_seconds", "Encoding one WebSocket patch")
+WS_SEND_SECONDS = Histogram("mt4_ws_send_seconds", "Sending one WebSocket message to one client")
+Gauge("mt4_accounts", "Accounts in memory", fn=lambda: len(accounts))
+Gauge("mt4_ws_clients", "Connected WebSocket clients", fn=lambda: len(active_connections))
+Gauge("mt4_ws_queue_depth", "Queued WebSocket messages across clients", ("stat",), fn=_client_queue_stats)
+Gauge("mt4_ingest_queue_length", "Reports waiting for an ingest worker", fn=lambda: sum(q.qsize() for q in ingest_queues))
+Counter("mt4_ingest_dropped_total", "Reports dropped because an ingest queue was full", fn=lambda: ingest_dropped)
+Gauge("mt4_db_queue_length", "Jobs waiting for the database writer", fn=lambda: db_writer.jobs.qsize())
+Counter("mt4_db_errors_total", "Failed database writes", fn=lambda: db_writer.errors)
+Gauge("mt4_notify_queue_length", "Alerts waiting to be sent", fn=lambda: notification_dispatcher.queue.qsize())
+Counter("mt4_notify_total", "Alerts by outcome", ("outcome",), fn=lambda: {
+    ("sent",): notification_dispatcher.sent,
+    ("failed",): notification_dispatcher.failed,
+    ("dropped",): notification_dispatcher.dropped,
+})
+
+#--- 性能诊断 ---
+class SamplingProfiler(threading.Thread):
+    """定时读取 sys._current_frames() 的采样分析器, 结果为 flamegraph.pl / speedscope 可读的折叠栈
+
+    只在独立线程中读取栈帧, 不设置 trace/profile 钩子, 被采样的代码没有额外开销。
+    """
+
+    def __init__(self, seconds: float, interval: float, thread_id: Optional[int]):
+        super().__init__(name="profiler", daemon=True)
+        self.seconds = seconds
+        self.interval = interval
+        self.thread_id = thread_id  # None 表示采样所有线程
+        self.stacks: Dict[str, int] = {}
+        self.samples = 0
+        self.started_at = time.monotonic()
+        self.stopped = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        deadline = self.started_at + self.seconds
+        while not self.stopped.wait(self.interval) and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own or (self.thread_id is not None and ident != self.thread_id):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+        self.stopped.set()
+
+    def stop(self) -> str:
+        self.stopped.set()
+        self.join()
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+profiler: Optional[SamplingProfiler] = None
+
+class IngestTrace:
+    """一条 (或一批) 上报的各阶段耗时: decode / queue / lock / update / risk, 之后的 broadcast 和 db 从处理完成时起算
+
+    处理完成后等待包含它的广播, 以及 history 写入 (如有) 提交; 两者都完成后判断是否超过 SLOW_INGEST_MS。
+    db 阶段本身包含 DB_FLUSH_INTERVAL 的合并等待, 因此它的阈值放宽同样的时间。
+    """
+
+    __slots__ = ('source', 'reports', 'started', 'last', 'stages', 'db_pending', 'broadcast_pending')
+
+    def __init__(self, source: str):
+        self.source = source
+        self.reports: List[str] = []
+        self.started = self.last = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.db_pending = False
+        self.broadcast_pending = False
+
+    def stage(self, name: str):
+        """把上一个标记点到现在的时间计入 name (可多次累加)"""
+        now = time.perf_counter()
+        self.stages[name] = self.stages.get(name, 0) + now - self.last
+        self.last = now
+
+    def processed(self, db_pending: bool):
+        self.db_pending = db_pending
+        self.broadcast_pending = True
+        traces_awaiting_broadcast.append(self)
+
+    def broadcasted(self, at: float):
+        self.stages["broadcast"] = at - self.last
+        self.broadcast_pending = False
+        self._finish()
+
+    def committed(self, at: float):
+        self.stages["db"] = at - self.last
+        self.db_pending = False
+        self._finish()
+
+    def _finish(self):
+        if self.db_pending or self.broadcast_pending:
+            return
+        threshold = SLOW_INGEST_MS / 1000
+        visible = self.last - self.started + self.stages["broadcast"]
+        stored = self.last - self.started + self.stages.get("db", 0)
+        if visible <= threshold and stored <= threshold + DB_FLUSH_INTERVAL:
+            return
+        stages_ms = {name: round(seconds * 1000, 3) for name, seconds in self.stages.items()}
+        slow_ingest_traces.append({
+            "time": datetime.now().isoformat(), "source": self.source, "accounts": self.reports,
+            "visible_ms": round(visible * 1000, 3), "stages_ms": stages_ms,
+        })
+        SLOW_INGEST.inc(labels=(self.source,))
+        print(f"Slow ingest ({self.source}, {len(self.reports)} reports, {visible * 1000:.0f}ms): "
+              + ", ".join(f"{name}={ms:.1f}ms" for name, ms in stages_ms.items()))
+
+traces_awaiting_broadcast: List[IngestTrace] = []
+slow_ingest_traces: deque = deque(maxlen=50)
+SLOW_INGEST = Counter("mt4_slow_ingest_total", "Reports slower than MT4_SLOW_INGEST_MS", ("source",))
+
+def start_trace(source: str) -> Optional[IngestTrace]:
+    return IngestTrace(source) if SLOW_INGEST_MS > 0 else None
+
+LOOP_LAG = Histogram("mt4_loop_lag_seconds", "Event loop heartbeat delay beyond its scheduled time")
+LOOP_STALLS = Counter("mt4_loop_stalls_total", "Times the event loop was blocked longer than MT4_LOOP_LAG_MS")
+
+class LoopWatchdog:
+    """事件循环心跳 + 监视线程
+
+    心跳协程每 LOOP_HEARTBEAT_INTERVAL 秒醒来一次, 记录实际延迟; 监视线程发现心跳超过
+    LOOP_LAG_MS 没有更新时, 循环正被同步代码占用, 此时读取事件循环线程的栈即为阻塞者。
+    每次阻塞只打印一次。
+    """
+
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread_id: Optional[int] = None
+        self.last_beat = time.monotonic()
+        self.reported_beat = None
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        threading.Thread(target=self.watch, name="loop-watchdog", daemon=True).start()
+        while True:
+            expected = time.monotonic() + LOOP_HEARTBEAT_INTERVAL
+            await asyncio.sleep(LOOP_HEARTBEAT_INTERVAL)
+            self.last_beat = time.monotonic()
+            LOOP_LAG.observe(max(0.0, self.last_beat - expected))
+
+    def watch(self):
+        threshold = LOOP_LAG_MS / 1000
+        while True:
+            time.sleep(max(0.01, threshold / 10))
+            beat = self.last_beat
+            blocked = time.monotonic() - beat - LOOP_HEARTBEAT_INTERVAL
+            if blocked <= threshold or beat == self.reported_beat:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.reported_beat = beat
+            LOOP_STALLS.inc()
+            task = asyncio.current_task(self.loop)
+            where = f"task {task.get_name()} ({task.get_coro().__qualname__})" if task else "callback"
+            print(f"Event loop blocked for {blocked * 1000:.0f}ms in {where}:\n"
+                  + "".join(traceback.format_stack(frame)).rstrip())
+
+loop_watchdog = LoopWatchdog()
 
 #--- 全局状态 ---
 accounts: Dict[str, AccountData] = {}
-active_connections: List[WebSocket] = []
-data_lock = asyncio.Lock()
+active_connections: List["ClientConnection"] = []
 
-#--- 通知队列 ---
-notification_queue: asyncio.Queue = asyncio.Queue()
+#--- 账户分片锁 ---
+# 同一账户的更新串行, 不同分片的账户互不等待; 读取方使用快照视图, 不加锁
+ACCOUNT_LOCK_SHARDS = 64
+account_locks = [asyncio.Lock() for _ in range(ACCOUNT_LOCK_SHARDS)]
 
-#--- 数据库初始化 ---
-def init_database():
-    conn = sqlite3.connect('mt4_monitor.db')
-    cursor = conn.cursor()
+@contextlib.asynccontextmanager
+async def locked_accounts(names: Iterable[str]):
+    """按分片序号从小到大获取锁, 批量之间不会死锁"""
+    acquired = []
+    started = time.perf_counter()
+    try:
+        for index in sorted({hash(name) % ACCOUNT_LOCK_SHARDS for name in names}):
+            await account_locks[index].acquire()
+            acquired.append(account_locks[index])
+        LOCK_WAIT_SECONDS.observe(time.perf_counter() - started)
+        yield
+    finally:
+        for lock in reversed(acquired):
+            lock.release()
+
+#--- WebSocket 增量协议 ---
+# init: 完整快照 + seq; patch: 仅包含自上一个 seq 以来变化的账户/字段
+# 客户端发现 seq 不连续时发送 {"type": "resync"} 重新获取快照
+WS_PROTOCOL_VERSION = 2
+ws_seq = 0
+
+#--- 快照视图 ---
+# 每次推进 ws_seq 时发布一份不可变视图 (各账户完整 JSON 片段), 与该 seq 的状态完全一致;
+# /api/accounts, /ws init 和 resync 共享同一份编码结果, 不再各自遍历全部账户
+class SnapshotView:
+    """某个 ws_seq 时刻全部账户的 JSON; 首次读取时拼接并缓存"""
     
-    cursor.execute('''
+    __slots__ = ('seq', '_fragments', '_accounts_json')
+    
+    def __init__(self, seq: int, fragments: tuple):
+        self.seq = seq
+        self._fragments = fragments
+        self._accounts_json: Optional[str] = None
+    
+    def accounts_json(self) -> str:
+        if self._accounts_json is None:
+            self._accounts_json = "{" + ",".join(self._fragments) + "}"
+            self._fragments = None
+        return self._accounts_json
+    
+    def message(self) -> str:
+        """WebSocket init 消息"""
+        return '{"type":"init","v":%d,"seq":%d,"data":%s,"timestamp":"%s"}' % (
+            WS_PROTOCOL_VERSION, self.seq, self.accounts_json(), datetime.now().isoformat()
+        )
+
+account_fragments: Dict[str, str] = {}  # 账户 -> '"name":{...}', 只由 build_patch 更新
+snapshot_view = SnapshotView(0, ())
+
+#--- 广播调度 ---
+# 写入路径只标记脏账户, 由 broadcast_scheduler 按 BROADCAST_HZ 合并推送
+dirty_accounts: Set[str] = set()
+broadcast_event = asyncio.Event()
+
+#--- 历史记录索引 ---
+history_last_saved: Dict[str, int] = {}  # 账户 -> 最后写入 history 的 timestamp
+
+#--- 数据库迁移 ---
+# 只允许在末尾追加新版本, 不修改已发布的迁移; PRAGMA user_version 记录当前版本
+MIGRATIONS: List[List[str]] = [
+    # v1: 初始表结构
+    [
+        '''
         CREATE TABLE IF NOT EXISTS accounts (
             account_name TEXT PRIMARY KEY,
             account_type TEXT,
@@ -152,9 +893,8 @@ def init_database():
             profit_target_pct REAL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-    
-    cursor.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS history (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             account_name TEXT,
@@ -168,9 +908,8 @@ def init_database():
             profit_progress_pct REAL,
             FOREIGN KEY (account_name) REFERENCES accounts(account_name)
         )
-    ''')
-    
-    cursor.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS notifications (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             account_name TEXT,
@@ -178,366 +917,1610 @@ def init_database():
             message TEXT,
             sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-    
-    conn.commit()
-    conn.close()
+        ''',
+    ],
+    # v2: 按账户+时间查询 history 的复合索引
+    [
+        'CREATE INDEX IF NOT EXISTS idx_history_account_ts ON history (account_name, timestamp)',
+    ],
+    # v3: 回撤列 + 小时/日汇总表
+    [
+        'ALTER TABLE history ADD COLUMN max_drawdown_pct REAL',
+        'CREATE INDEX IF NOT EXISTS idx_history_ts ON history (timestamp)',
+        '''
+        CREATE TABLE IF NOT EXISTS history_1h (
+            account_name TEXT,
+            bucket INTEGER,
+            count INTEGER,
+            equity_open REAL,
+            equity_high REAL,
+            equity_low REAL,
+            equity_close REAL,
+            balance_open REAL,
+            balance_high REAL,
+            balance_low REAL,
+            balance_close REAL,
+            today_pnl_low REAL,
+            today_pnl_high REAL,
+            today_pnl REAL,
+            total_pnl REAL,
+            drawdown_max REAL,
+            PRIMARY KEY (account_name, bucket)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS history_1d (
+            account_name TEXT,
+            bucket INTEGER,
+            count INTEGER,
+            equity_open REAL,
+            equity_high REAL,
+            equity_low REAL,
+            equity_close REAL,
+            balance_open REAL,
+            balance_high REAL,
+            balance_low REAL,
+            balance_close REAL,
+            today_pnl_low REAL,
+            today_pnl_high REAL,
+            today_pnl REAL,
+            total_pnl REAL,
+            drawdown_max REAL,
+            PRIMARY KEY (account_name, bucket)
+        ) WITHOUT ROWID
+        ''',
+    ],
+    # v4: 汇总进度 (已汇总到的 history.id)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER
+        )
+        ''',
+    ],
+]
 
-#--- 通知处理器 ---
-async def notification_worker():
-    """后台通知处理器"""
-    while True:
+def migrate_database(conn: sqlite3.Connection):
+    """把数据库升级到最新版本, 每个版本在独立事务中执行"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version > len(MIGRATIONS):
+        print(f"Database schema v{version} is newer than this server (v{len(MIGRATIONS)})")
+        return
+    
+    for target in range(version + 1, len(MIGRATIONS) + 1):
+        started = time.monotonic()
         try:
-            alert = await notification_queue.get()
-            await send_telegram_notification(alert)
-            notification_queue.task_done()
-        except Exception as e:
-            print(f"Notification error: {e}")
-            await asyncio.sleep(5)
+            conn.execute('BEGIN')
+            for sql in MIGRATIONS[target - 1]:
+                conn.execute(sql)
+            conn.execute(f'PRAGMA user_version = {target}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Database migrated to v{target} in {time.monotonic() - started:.2f}s")
 
-async def send_telegram_notification(alert: dict):
-    """发送Telegram通知"""
-    if not TELEGRAM_ENABLED:
-        return
+#--- 数据库初始化 ---
+def connect_readonly() -> sqlite3.Connection:
+    """只读连接; 可在线程池中跨线程顺序使用"""
+    uri = Path(DB_PATH).resolve().as_uri() + "?mode=ro"
+    return sqlite3.connect(uri, uri=True, timeout=DB_LOCK_TIMEOUT, check_same_thread=False)
+
+def init_database():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_LOCK_TIMEOUT, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    migrate_database(conn)
+    conn.close()
+
+#--- 数据库写入线程 ---
+class DatabaseWriter(threading.Thread):
+    """独占一个长连接 (WAL) 的写线程
     
-    try:
-        # 使用OpenClaw的消息工具
-        from message import message as msg_tool
+    事件循环只负责入队, 写入按 DB_BATCH_SIZE 条或 DB_FLUSH_INTERVAL 秒合并为一次提交。
+    """
+    
+    _STOP = object()
+    
+    def __init__(self, path: str):
+        super().__init__(name="db-writer", daemon=True)
+        self.path = path
+        self.jobs: queue.Queue = queue.Queue()
+        self.committed = 0
+        self.errors = 0
+    
+    def submit(self, job, done=None):
+        """job(cursor) 在写线程中执行; done() 在所在批次提交 (或失败) 后于写线程中调用"""
+        self.jobs.put((job, done))
+    
+    def execute(self, sql: str, params: tuple = ()):
+        self.submit(lambda cursor: cursor.execute(sql, params))
+    
+    def stop(self, timeout: float = 10):
+        """提交剩余写入后退出"""
+        self.jobs.put(self._STOP)
+        self.join(timeout)
+    
+    def run(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        cursor = conn.cursor()
         
-        emoji = {"danger": "🚨", "warning": "⚠️", "info": "ℹ️"}.get(alert['level'], "ℹ️")
+        running = True
+        while running:
+            item = self.jobs.get()
+            if item is self._STOP:
+                break
+            
+            batch = [item]
+            deadline = time.monotonic() + DB_FLUSH_INTERVAL
+            while len(batch) < DB_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.jobs.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    running = False
+                    break
+                batch.append(item)
+            
+            started = time.perf_counter()
+            for job, _ in batch:
+                try:
+                    job(cursor)
+                except Exception as e:
+                    self.errors += 1
+                    print(f"Database write error: {e}")
+            try:
+                conn.commit()
+                self.committed += len(batch)
+                DB_FLUSH_SECONDS.observe(time.perf_counter() - started)
+                DB_BATCH_JOBS.observe(len(batch))
+            except sqlite3.Error as e:
+                self.errors += len(batch)
+                print(f"Database commit error: {e}")
+                conn.rollback()
+            for _, done in batch:
+                if done is not None:
+                    done()
         
-        text = f"""{emoji} <b>MT4 Monitor Alert</b>
+        conn.close()
 
-<b>Account:</b> {alert['account']}
-<b>Type:</b> {alert['type']}
-<b>Level:</b> {alert['level'].upper()}
+db_writer = DatabaseWriter(DB_PATH)
 
-{alert['message']}
+#--- 只读连接池 ---
+class ReadPool:
+    """历史/统计查询在专用线程池中用只读 (WAL) 连接执行, 不占用事件循环
 
-<i>{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</i>"""
+    同时最多 size 个查询, 其余排队; 排队加执行超过 timeout 秒时用 interrupt() 中止查询。
+    流式导出 (stream) 在整个导出期间占用一个名额, 每取一块超过 timeout 秒时中止。
+    """
+    
+    def __init__(self, size: int, timeout: float):
+        self.size = size
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="db-read")
+        self.slots = asyncio.Semaphore(size)
+        self.idle: List[sqlite3.Connection] = []
+        self.timeouts = 0
+    
+    async def acquire(self) -> sqlite3.Connection:
+        """占用一个名额并取一个连接, 用完交给 release; 等待超过 timeout 秒时返回 503"""
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise HTTPException(status_code=503, detail="Too many history queries, try again later")
         
-        msg_tool(action="send", target=TELEGRAM_CHAT_ID, message=text)
+        try:
+            return self.idle.pop() if self.idle else connect_readonly()
+        except BaseException:
+            self.slots.release()
+            raise
+    
+    def release(self, conn: sqlite3.Connection):
+        self.idle.append(conn)
+        self.slots.release()
+    
+    async def run(self, fn, *args):
+        """在池中执行 fn(cursor, *args) 并返回结果"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        conn = await self.acquire()
+        future = loop.run_in_executor(self.executor, self._execute, conn, fn, args)
+        
+        def release(done: asyncio.Future):
+            # 查询真正结束后才归还连接和并发名额 (超时/客户端断开时也一样); 被中止的查询的异常在这里取走
+            done.exception()
+            self.release(conn)
+        future.add_done_callback(release)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), max(0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            conn.interrupt()
+            raise HTTPException(status_code=504, detail=f"Query exceeded {self.timeout:g}s")
+        except asyncio.CancelledError:
+            conn.interrupt()
+            raise
+    
+    async def stream(self, fn, *args):
+        """在池中逐块执行生成器 fn(cursor, *args), 返回异步迭代器
+        
+        第一块在返回前取出, 排队超时和查询错误仍能作为普通 HTTP 错误返回;
+        之后的迭代器即使未被消费也会在回收时归还连接。
+        """
+        chunks = self._stream(await self.acquire(), fn, args)
+        try:
+            first = await chunks.__anext__()
+        except StopAsyncIteration:
+            first = None
         
-        # 记录到数据库
-        conn = sqlite3.connect('mt4_monitor.db')
+        async def rest():
+            if first is None:
+                return
+            yield first
+            async for chunk in chunks:
+                yield chunk
+        return rest()
+    
+    async def _stream(self, conn: sqlite3.Connection, fn, args: tuple):
+        loop = asyncio.get_running_loop()
         cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO notifications (account_name, alert_type, message)
-            VALUES (?, ?, ?)
-        ''', (alert['account'], alert['type'], alert['message']))
-        conn.commit()
-        conn.close()
+        chunks = fn(cursor, *args)
         
-        print(f"Notification sent: {alert['account']} - {alert['type']}")
+        def finish(step: Optional[asyncio.Future] = None):
+            if step is not None:
+                step.exception()
+            chunks.close()
+            cursor.close()
+            self.release(conn)
         
-    except Exception as e:
-        print(f"Failed to send notification: {e}")
+        step = None
+        try:
+            while True:
+                step = loop.run_in_executor(self.executor, next, chunks, None)
+                try:
+                    chunk = await asyncio.wait_for(asyncio.shield(step), self.timeout)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    raise HTTPException(status_code=504, detail=f"Query exceeded {self.timeout:g}s")
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            if step is not None and not step.done():
+                # 超时或客户端断开: 中止查询, 这一块真正结束后再归还连接
+                conn.interrupt()
+                step.add_done_callback(finish)
+            else:
+                finish(step)
+    
+    @staticmethod
+    def _execute(conn: sqlite3.Connection, fn, args: tuple):
+        cursor = conn.cursor()
+        try:
+            return fn(cursor, *args)
+        finally:
+            cursor.close()
 
-def queue_notification(account: AccountData, alert_type: str, message: str, level: str = "info"):
-    """将通知加入队列"""
-    if account.alert_sent:  # 只报一次
-        return
+read_pool = ReadPool(DB_READERS, DB_QUERY_TIMEOUT)
+Counter("mt4_db_read_rejected_total", "History/stats queries that timed out or found the pool full", fn=lambda: read_pool.timeouts)
+
+#--- 通知处理器 ---
+class TransportUnavailable(Exception):
+    """重试也无法恢复的发送失败 (如缺少依赖), 不再重试"""
+
+class NotificationTransport:
+    """通知发送方式; send 失败时抛出异常以触发重试, 抛出 TransportUnavailable 则直接放弃"""
+    
+    async def send(self, text: str):
+        raise NotImplementedError
+
+class TelegramTransport(NotificationTransport):
+    """通过 OpenClaw 的消息工具发送, 同步调用放到线程池"""
+    
+    def __init__(self):
+        self.import_error: Optional[ImportError] = None  # 导入失败只报告一次, 之后直接放弃
     
-    alert = {
-        'account': account.account_name,
+    async def send(self, text: str):
+        if self.import_error is not None:
+            raise TransportUnavailable(f"message tool unavailable: {self.import_error}")
+        try:
+            from message import message as msg_tool
+        except ImportError as e:
+            self.import_error = e
+            raise TransportUnavailable(f"message tool unavailable: {e}")
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, lambda: msg_tool(action="send", target=TELEGRAM_CHAT_ID, message=text))
+
+class WebhookTransport(NotificationTransport):
+    """POST {"chat_id", "text", "parse_mode"} JSON 到指定地址"""
+    
+    def __init__(self, url: str, timeout: float = 10):
+        self.url = url
+        self.timeout = timeout
+    
+    async def send(self, text: str):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._post, text)
+    
+    def _post(self, text: str):
+        body = json.dumps({"chat_id": TELEGRAM_CHAT_ID, "text": text, "parse_mode": "HTML"}).encode()
+        request = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+def make_notification_transport() -> Optional[NotificationTransport]:
+    if not TELEGRAM_ENABLED:
+        return None
+    if NOTIFY_WEBHOOK_URL:
+        return WebhookTransport(NOTIFY_WEBHOOK_URL)
+    return TelegramTransport()
+
+def format_alerts(account_name: str, alerts: List[dict]) -> str:
+    """把同一账户的一组告警格式化为一条消息"""
+    levels = [alert['level'] for alert in alerts]
+    level = next((l for l in ("danger", "warning", "info") if l in levels), "info")
+    emoji = {"danger": "🚨", "warning": "⚠️", "info": "ℹ️"}[level]
+    
+    if len(alerts) == 1:
+        alert = alerts[0]
+        body = f"""<b>Type:</b> {alert['type']}
+<b>Level:</b> {alert['level'].upper()}
+
+{alert['message']}"""
+    else:
+        body = "\n\n".join(
+            f"<b>{alert['type']}</b> ({alert['level'].upper()})\n{alert['message']}" for alert in alerts
+        )
+    
+    return f"""{emoji} <b>MT4 Monitor Alert</b>
+
+<b>Account:</b> {account_name}
+{body}
+
+<i>{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</i>"""
+
+class NotificationDispatcher:
+    """后台通知分发: 有界队列 + 按账户合并 + 指数退避重试, 发送不占用事件循环
+    
+    固定 NOTIFY_SENDERS 个发送协程; 全部在发送/重试时告警留在队列中, 通道故障时队列满后丢弃最旧的。
+    """
+    
+    def __init__(self, transport: Optional[NotificationTransport], maxsize: int = NOTIFY_QUEUE_SIZE):
+        self.transport = transport
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+    
+    def put(self, alert: dict):
+        """非阻塞入队; 队列满时丢弃最旧的一条, 保证最新告警能送达"""
+        try:
+            self.queue.put_nowait(alert)
+        except asyncio.QueueFull:
+            self.queue.get_nowait()
+            self.dropped += 1
+            if self.dropped % 100 == 1:  # 通道长时间故障时不刷屏
+                print(f"Notification queue full, dropped oldest alert ({self.dropped} so far)")
+            self.queue.put_nowait(alert)
+    
+    async def run(self):
+        await asyncio.gather(*(self.sender() for _ in range(max(1, NOTIFY_SENDERS))))
+    
+    async def sender(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + NOTIFY_COALESCE_SECONDS
+            while True:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            by_account: Dict[str, List[dict]] = {}
+            for alert in batch:
+                by_account.setdefault(alert['account'], []).append(alert)
+            for account_name, alerts in by_account.items():
+                await self.deliver(account_name, alerts)
+    
+    async def deliver(self, account_name: str, alerts: List[dict]):
+        if self.transport is None:
+            return
+        
+        text = format_alerts(account_name, alerts)
+        for attempt in range(NOTIFY_MAX_RETRIES + 1):
+            try:
+                await self.transport.send(text)
+                break
+            except Exception as e:
+                if attempt == NOTIFY_MAX_RETRIES or isinstance(e, TransportUnavailable):
+                    self.failed += len(alerts)
+                    print(f"Failed to send notification: {account_name} - {e}")
+                    return
+                await asyncio.sleep(min(60, 2 ** attempt))
+        
+        self.sent += len(alerts)
+        for alert in alerts:
+            db_writer.execute('''
+                INSERT INTO notifications (account_name, alert_type, message)
+                VALUES (?, ?, ?)
+            ''', (alert['account'], alert['type'], alert['message']))
+        print(f"Notification sent: {account_name} - {', '.join(alert['type'] for alert in alerts)}")
+
+notification_dispatcher = NotificationDispatcher(make_notification_transport())
+
+def notify(account_name: str, alert_type: str, message: str, level: str = "info"):
+    """将一条告警放入发送队列"""
+    notification_dispatcher.put({
+        'account': account_name,
         'type': alert_type,
         'message': message,
         'level': level,
         'timestamp': datetime.now().isoformat()
-    }
-    
-    try:
-        notification_queue.put_nowait(alert)
-        account.alert_sent = True
-    except asyncio.QueueFull:
-        print("Notification queue full")
+    })
+
+#--- 风险规则引擎 ---
+# 每家 Prop Firm 的规则以数据声明 (RULE_SETS), 启动时编译; 每条规则只在其依赖字段变化时重新求值。
+# 状态按 levels 顺序 (最严重在前) 取第一个满足的级别; 回落到较轻状态时, 指标需越过阈值 hysteresis 才生效, 避免告警抖动。
+# 进入带 alert 的级别时发送一次告警 (alert: 类型, 消息模板, 级别; 模板可用 {value} 和 {a.字段})
+
+def _pct(part: float, whole: float) -> Optional[float]:
+    return part / whole * 100 if whole else None
+
+# 派生指标: 名称 -> (依赖字段, 计算函数); 返回 None 表示不适用。账户字段可直接作为指标使用
+# EA 未上报亏损限额 (daily_loss_limit / total_loss_limit 为 0, 如 MQ4 版) 时, 剩余额度也是 0, 相关指标不适用
+RISK_METRICS = {
+    "daily_loss_left": (
+        ("daily_loss_remaining", "daily_loss_limit"),
+        lambda a: a.daily_loss_remaining if a.daily_loss_limit else None,
+    ),
+    "total_loss_left": (
+        ("total_loss_remaining", "total_loss_limit"),
+        lambda a: a.total_loss_remaining if a.total_loss_limit else None,
+    ),
+    "daily_loss_used_pct": (
+        ("initial_balance", "max_daily_loss_pct", "daily_loss_remaining", "daily_loss_limit"),
+        lambda a: _pct(a.initial_balance * a.max_daily_loss_pct / 100 - a.daily_loss_remaining,
+                       a.initial_balance * a.max_daily_loss_pct / 100) if a.daily_loss_limit else None,
+    ),
+    "daily_loss_remaining_pct": (
+        ("daily_loss_remaining", "challenge_size", "daily_loss_limit"),
+        lambda a: _pct(a.daily_loss_remaining, a.challenge_size) if a.daily_loss_limit else None,
+    ),
+    "total_loss_remaining_pct": (
+        ("total_loss_remaining", "challenge_size", "total_loss_limit"),
+        lambda a: _pct(a.total_loss_remaining, a.challenge_size) if a.total_loss_limit else None,
+    ),
+    "pnl_loss_alert_margin": (
+        ("today_pnl_pct", "daily_loss_alert_pct"),
+        lambda a: a.today_pnl_pct + a.daily_loss_alert_pct if a.daily_loss_alert_pct > 0 else None,
+    ),
+    "pnl_profit_alert_margin": (
+        ("today_pnl_pct", "daily_profit_alert_pct"),
+        lambda a: a.today_pnl_pct - a.daily_profit_alert_pct if a.daily_profit_alert_pct > 0 else None,
+    ),
+}
+
+DAILY_LOSS_OF_LIMIT = {
+    "levels": [
+        {"state": "danger", "when": "daily_loss_used_pct >= 100",
+         "alert": ("Daily Loss Limit", "Daily loss limit exceeded! Used: {value:.1f}%", "danger")},
+        {"state": "warning", "when": "daily_loss_used_pct >= 80",
+         "alert": ("Daily Loss Warning", "Daily loss at {value:.1f}% of limit", "warning")},
+    ],
+    "otherwise": "safe",
+    "hysteresis": 2,
+}
+
+# FTMO 1-Step: 按剩余额度占挑战规模的比例
+DAILY_LOSS_FTMO_1STEP = {
+    "levels": [
+        {"state": "danger", "when": "daily_loss_left <= 0",
+         "alert": ("Daily Loss Limit", "Daily loss limit exceeded! Remaining: ${a.daily_loss_remaining:.2f}", "danger")},
+        {"state": "danger", "when": "daily_loss_remaining_pct < 1",
+         "alert": ("Daily Loss Warning", "Daily loss limit almost reached! Only ${a.daily_loss_remaining:.2f} remaining", "warning")},
+        {"state": "warning", "when": "daily_loss_remaining_pct < 1.5"},
+    ],
+    "otherwise": "safe",
+    "hysteresis": 0.1,
+}
+
+TOTAL_LOSS = {
+    "levels": [
+        {"state": "danger", "when": "total_loss_left <= 0",
+         "alert": ("Total Loss Limit", "Total loss limit exceeded! Account at risk!", "danger")},
+        {"state": "danger", "when": "total_loss_remaining_pct < 2",
+         "alert": ("Total Loss Warning", "Total loss limit almost reached! Only ${a.total_loss_remaining:.2f} remaining", "danger")},
+        {"state": "warning", "when": "total_loss_remaining_pct < 5"},
+    ],
+    "otherwise": "safe",
+    "hysteresis": 0.2,
+}
 
-#--- 计算风险状态 ---
-def calculate_risk_status(account: AccountData) -> AccountData:
-    """计算各项风险状态并触发通知"""
+PROFIT_TARGET = {
+    "levels": [
+        {"state": "completed", "when": "profit_progress_pct >= 100",
+         "alert": ("Profit Target Reached", "🎉 Profit target achieved! Progress: {value:.1f}%", "info")},
+        {"state": "close", "when": "profit_progress_pct >= 80"},
+        {"state": "progress", "when": "profit_progress_pct >= 50"},
+    ],
+    "otherwise": "pending",
+    "hysteresis": 2,
+}
+
+PNL_ALERT = {
+    "levels": [
+        {"state": True, "when": "pnl_loss_alert_margin <= 0",
+         "alert": ("PnL Alert", "Daily PnL dropped {a.today_pnl_pct:.1f}% (alert at -{a.daily_loss_alert_pct}%)", "warning")},
+        {"state": True, "when": "pnl_profit_alert_margin >= 0",
+         "alert": ("PnL Alert", "Daily PnL reached +{a.today_pnl_pct:.1f}% (alert at +{a.daily_profit_alert_pct}%)", "info")},
+    ],
+    "otherwise": False,
+    "hysteresis": 0.2,
+}
+
+# 规则集: 状态字段 -> 规则; 未列出的 account_type 使用 DEFAULT, 规则集中没有的状态保持初始值
+RULE_SETS = {
+    "DEFAULT": {
+        "daily_loss_risk": DAILY_LOSS_OF_LIMIT,
+        "total_loss_risk": TOTAL_LOSS,
+        "profit_target_risk": PROFIT_TARGET,
+        "pnl_alert_triggered": PNL_ALERT,
+    },
+    "FTMO_1STEP": {
+        "daily_loss_risk": DAILY_LOSS_FTMO_1STEP,
+        "total_loss_risk": TOTAL_LOSS,
+        "profit_target_risk": PROFIT_TARGET,
+        "pnl_alert_triggered": PNL_ALERT,
+    },
+    # Darwinex Zero 没有日损限制和利润目标
+    "PROP_DARWINEX": {
+        "total_loss_risk": TOTAL_LOSS,
+        "pnl_alert_triggered": PNL_ALERT,
+    },
+    # 5ers 的日损/总损/目标比例由 EA 参数给出, 与 DEFAULT 的计算方式相同
+    "PROP_5ERS": {
+        "daily_loss_risk": DAILY_LOSS_OF_LIMIT,
+        "total_loss_risk": TOTAL_LOSS,
+        "profit_target_risk": PROFIT_TARGET,
+        "pnl_alert_triggered": PNL_ALERT,
+    },
+}
+
+RISK_STATE_FIELDS = ("daily_loss_risk", "total_loss_risk", "profit_target_risk", "pnl_alert_triggered")
+_RULE_OPERATORS = {">=": operator.ge, ">": operator.gt, "<=": operator.le, "<": operator.lt}
+
+def _compile_metric(metric: str) -> tuple:
+    if metric in RISK_METRICS:
+        return RISK_METRICS[metric]
+    if metric in REPORT_FIELD_NAMES:
+        return (metric,), operator.attrgetter(metric)
+    raise ValueError(f"Unknown metric `{metric}`")
+
+class CompiledRule:
+    """一条规则的求值器"""
     
-    # 日损风险
-    if account.is_ftmo_1step:
-        if account.daily_loss_remaining <= 0:
-            if account.daily_loss_risk != "danger":
-                queue_notification(
-                    account, 
-                    "Daily Loss Limit", 
-                    f"Daily loss limit exceeded! Remaining: ${account.daily_loss_remaining:.2f}",
-                    "danger"
-                )
-            account.daily_loss_risk = "danger"
-        elif account.daily_loss_remaining < account.challenge_size * 0.01:
-            if account.daily_loss_risk != "danger":
-                queue_notification(
-                    account,
-                    "Daily Loss Warning",
-                    f"Daily loss limit almost reached! Only ${account.daily_loss_remaining:.2f} remaining",
-                    "warning"
-                )
-            account.daily_loss_risk = "danger"
-        elif account.daily_loss_remaining < account.challenge_size * 0.015:
-            account.daily_loss_risk = "warning"
+    __slots__ = ('field', 'levels', 'otherwise', 'metrics')
+    
+    def __init__(self, field: str, spec: dict):
+        self.field = field
+        self.otherwise = spec["otherwise"]
+        hysteresis = spec.get("hysteresis", 0)
+        levels = []
+        for level in spec["levels"]:
+            metric, op, threshold = level["when"].split()
+            threshold = float(threshold)
+            # 回落时的阈值: 向"恢复"方向放宽 hysteresis
+            hold = threshold - hysteresis if op in (">=", ">") else threshold + hysteresis
+            compute = _compile_metric(metric)[1]
+            levels.append((level["state"], metric, compute, _RULE_OPERATORS[op], threshold, hold, level.get("alert")))
+        self.levels = tuple(levels)
+        self.metrics = tuple(dict.fromkeys(level[1] for level in levels))
+    
+    def evaluate(self, account: AccountData) -> Optional[tuple]:
+        """返回 (新状态, 触发的级别告警, 指标值); 状态不变时返回 None"""
+        current = getattr(account, self.field)
+        for state, _, compute, compare, threshold, _, alert in self.levels:
+            value = compute(account)
+            if value is not None and compare(value, threshold):
+                break
         else:
-            account.daily_loss_risk = "safe"
-    else:
-        daily_loss_used = account.initial_balance * (account.max_daily_loss_pct / 100) - account.daily_loss_remaining
-        daily_loss_pct_used = (daily_loss_used / (account.initial_balance * account.max_daily_loss_pct / 100)) * 100 if account.initial_balance > 0 else 0
+            state, alert, value = self.otherwise, None, None
         
-        if daily_loss_pct_used >= 100:
-            if account.daily_loss_risk != "danger":
-                queue_notification(
-                    account,
-                    "Daily Loss Limit",
-                    f"Daily loss limit exceeded! Used: {daily_loss_pct_used:.1f}%",
-                    "danger"
-                )
-            account.daily_loss_risk = "danger"
-        elif daily_loss_pct_used >= 80:
-            if account.daily_loss_risk != "warning":
-                queue_notification(
-                    account,
-                    "Daily Loss Warning",
-                    f"Daily loss at {daily_loss_pct_used:.1f}% of limit",
-                    "warning"
-                )
-            account.daily_loss_risk = "warning"
-        else:
-            account.daily_loss_risk = "safe"
-    
-    # 总损风险
-    if account.total_loss_remaining <= 0:
-        if account.total_loss_risk != "danger":
-            queue_notification(
-                account,
-                "Total Loss Limit",
-                f"Total loss limit exceeded! Account at risk!",
-                "danger"
-            )
-        account.total_loss_risk = "danger"
-    elif account.total_loss_remaining < account.challenge_size * 0.02:
-        if account.total_loss_risk != "danger":
-            queue_notification(
-                account,
-                "Total Loss Warning",
-                f"Total loss limit almost reached! Only ${account.total_loss_remaining:.2f} remaining",
-                "danger"
-            )
-        account.total_loss_risk = "danger"
-    elif account.total_loss_remaining < account.challenge_size * 0.05:
-        account.total_loss_risk = "warning"
-    else:
-        account.total_loss_risk = "safe"
-    
-    # 利润目标状态
-    if account.profit_progress_pct >= 100:
-        if account.profit_target_risk != "completed":
-            queue_notification(
-                account,
-                "Profit Target Reached",
-                f"🎉 Profit target achieved! Progress: {account.profit_progress_pct:.1f}%",
-                "info"
-            )
-        account.profit_target_risk = "completed"
-    elif account.profit_progress_pct >= 80:
-        account.profit_target_risk = "close"
-    elif account.profit_progress_pct >= 50:
-        account.profit_target_risk = "progress"
-    else:
-        account.profit_target_risk = "pending"
-    
-    # PnL 预警检查
-    if account.daily_loss_alert_pct > 0 and account.today_pnl_pct <= -account.daily_loss_alert_pct:
-        if not account.pnl_alert_triggered:
-            queue_notification(
-                account,
-                "PnL Alert",
-                f"Daily PnL dropped {account.today_pnl_pct:.1f}% (alert at -{account.daily_loss_alert_pct}%)",
-                "warning"
-            )
-        account.pnl_alert_triggered = True
-    elif account.daily_profit_alert_pct > 0 and account.today_pnl_pct >= account.daily_profit_alert_pct:
-        if not account.pnl_alert_triggered:
-            queue_notification(
-                account,
-                "PnL Alert",
-                f"Daily PnL reached +{account.today_pnl_pct:.1f}% (alert at +{account.daily_profit_alert_pct}%)",
-                "info"
-            )
-        account.pnl_alert_triggered = True
+        if state == current:
+            return None
+        # 比当前状态更严重的级别立即生效; 变轻时当前状态的某个级别仍在缓冲带内则保持
+        if self.severity(state) > self.severity(current):
+            for level_state, _, compute, compare, _, hold, _ in self.levels:
+                if level_state == current:
+                    held = compute(account)
+                    if held is not None and compare(held, hold):
+                        return None
+        return state, alert, value
+    
+    def severity(self, state) -> int:
+        """级别序号, 越小越严重; otherwise 最轻"""
+        for index, level in enumerate(self.levels):
+            if level[0] == state:
+                return index
+        return len(self.levels)
+
+class CompiledRuleSet:
+    """一个规则集, 按指标建立阈值索引
+    
+    状态只可能在指标越过某个阈值 (或缓冲带边界) 时变化: 指标从 old 变到 new 时,
+    用二分查找取出阈值落在 [old, new] 之间的规则求值, 开销与规则总数无关。
+    """
+    
+    __slots__ = ('name', 'rules', 'metrics', 'metrics_by_field', 'thresholds', 'rules_by_metric', 'unmanaged')
+    
+    def __init__(self, name: str, specs: dict):
+        self.name = name
+        self.rules = tuple(CompiledRule(field, spec) for field, spec in specs.items())
+        self.metrics: Dict[str, object] = {}
+        metrics_by_field: Dict[str, list] = {}
+        bounds: Dict[str, list] = {}
+        rules_by_metric: Dict[str, list] = {}
+        for rule in self.rules:
+            for _, metric, _, _, threshold, hold, _ in rule.levels:
+                bounds.setdefault(metric, []).extend(((threshold, rule), (hold, rule)))
+            for metric in rule.metrics:
+                rules_by_metric.setdefault(metric, []).append(rule)
+                if metric not in self.metrics:
+                    deps, compute = _compile_metric(metric)
+                    self.metrics[metric] = compute
+                    for dep in deps:
+                        metrics_by_field.setdefault(dep, []).append(metric)
+        self.metrics_by_field = {field: tuple(metrics) for field, metrics in metrics_by_field.items()}
+        # 指标 -> (排序后的阈值, 对应规则)
+        self.thresholds = {}
+        for metric, pairs in bounds.items():
+            pairs.sort(key=lambda pair: pair[0])
+            self.thresholds[metric] = ([value for value, _ in pairs], [rule for _, rule in pairs])
+        self.rules_by_metric = {metric: tuple(rules) for metric, rules in rules_by_metric.items()}
+        # 本规则集不管理的状态字段保持初始值
+        self.unmanaged = tuple(
+            (field, default) for field, default in RUNTIME_FIELDS if field in RISK_STATE_FIELDS and field not in specs
+        )
+    
+    def affected(self, account: AccountData, changed: Iterable[str]) -> Dict[CompiledRule, None]:
+        """重新计算受变化字段影响的指标, 返回有阈值被越过的规则 (去重)"""
+        values = account.risk_metrics
+        metrics = {}
+        for field in changed:
+            for metric in self.metrics_by_field.get(field, ()):
+                metrics[metric] = None
+        
+        rules = {}
+        for metric in metrics:
+            new = self.metrics[metric](account)
+            old = values.get(metric)
+            if new == old:
+                continue
+            values[metric] = new
+            if new is None or old is None:
+                candidates = self.rules_by_metric[metric]
+            else:
+                keys, owners = self.thresholds[metric]
+                low, high = (old, new) if old < new else (new, old)
+                candidates = owners[bisect.bisect_left(keys, low):bisect.bisect_right(keys, high)]
+            for rule in candidates:
+                rules[rule] = None
+        return rules
+    
+    def reset(self, account: AccountData):
+        """切换到本规则集: 记录全部指标的当前值"""
+        account.risk_metrics = {metric: compute(account) for metric, compute in self.metrics.items()}
+        for field, default in self.unmanaged:
+            account.set(field, default)
+
+COMPILED_RULE_SETS = {name: CompiledRuleSet(name, specs) for name, specs in RULE_SETS.items()}
+
+def rule_set_for(account: AccountData) -> CompiledRuleSet:
+    if account.is_ftmo_1step:
+        return COMPILED_RULE_SETS["FTMO_1STEP"]
+    return COMPILED_RULE_SETS.get(account.account_type) or COMPILED_RULE_SETS["DEFAULT"]
+
+def evaluate_risk(account: AccountData, changed: Iterable[str]):
+    """按本次变化的字段重新计算相关风险状态, 进入告警级别时发送通知"""
+    rule_set = rule_set_for(account)
+    if rule_set is not account.rules:
+        # 首次上报或账户类型变化: 全部重新求值
+        account.rules = rule_set
+        rule_set.reset(account)
+        rules = rule_set.rules
     else:
-        account.pnl_alert_triggered = False
-        account.alert_sent = False  # 重置，允许新的预警
+        rules = rule_set.affected(account, changed)
     
-    return account
+    for rule in rules:
+        result = rule.evaluate(account)
+        if result is None:
+            continue
+        state, alert, value = result
+        account.set(rule.field, state)
+        if alert is not None:
+            alert_type, template, level = alert
+            notify(account.account_name, alert_type, template.format(value=value, a=account), level)
 
 #--- ZeroMQ 数据接收器 ---
+# EA 使用 REQ 套接字; ROUTER 可以同时处理多个 EA 的请求:
+# 校验通过立即回复 OK, 实际处理交给按账户分片的工作协程 (保证同一账户按顺序处理)
+ingest_queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=INGEST_QUEUE_SIZE) for _ in range(max(1, INGEST_WORKERS))]
+ingest_dropped = 0
+ingest_errors: Dict[str, Dict[str, int]] = {"zmq": {}, "http": {}}
+recent_ingest_errors: deque = deque(maxlen=50)
+
+def record_ingest_error(source: str, error: PayloadError):
+    """按来源和类型计数, 保留最近的错误样本用于排查"""
+    ingest_errors[source][error.kind] = ingest_errors[source].get(error.kind, 0) + 1
+    INGEST_ERRORS.inc(labels=(source, error.kind))
+    recent_ingest_errors.append({
+        "time": datetime.now().isoformat(), "source": source, "kind": error.kind, "error": str(error)
+    })
+
+def shard_for(account_name: str) -> asyncio.Queue:
+    """同一账户总在同一分片, 保证按到达顺序处理"""
+    return ingest_queues[hash(account_name) % len(ingest_queues)]
+
+def enqueue_ingest(data, trace: Optional[IngestTrace] = None):
+    """按账户名分片放入工作队列; 批量 (list) 按账户拆到各自分片, 每个分片内一起处理"""
+    global ingest_dropped
+    if not isinstance(data, list):
+        parts = {shard_for(data.account_name): data}
+    else:
+        parts = {}
+        for report in data:
+            parts.setdefault(shard_for(report.account_name), []).append(report)
+    
+    for shard, part in parts.items():
+        try:
+            # 耗时追踪只跟随第一部分
+            shard.put_nowait((part, trace))
+        except asyncio.QueueFull:
+            ingest_dropped += len(part) if isinstance(part, list) else 1
+            first = part[0] if isinstance(part, list) else part
+            print(f"Ingest queue full, dropped report from {first.account_name}")
+        trace = None
+
+async def ingest_worker(shard: asyncio.Queue):
+    """处理一个分片中的 EA 数据"""
+    while True:
+        data, trace = await shard.get()
+        if trace is not None:
+            trace.stage("queue")
+        try:
+            if isinstance(data, list):
+                await process_account_batch(data, trace)
+            else:
+                await process_account_data(data, trace)
+        except Exception as e:
+            print(f"Error processing message: {e}")
+
 async def zmq_receiver():
     """接收来自MT4/5 EA的数据"""
     context = zmq.asyncio.Context()
-    socket = context.socket(zmq.REP)
-    socket.bind("tcp://0.0.0.0:5555")
+    socket = context.socket(zmq.ROUTER)
+    socket.bind(ZMQ_BIND)
     
-    print("ZeroMQ server listening on port 5555...")
+    print(f"ZeroMQ server listening on {ZMQ_BIND}...")
     
     while True:
-        try:
-            message = await socket.recv_string()
-            data = json.loads(message)
-            
-            await process_account_data(data)
-            await socket.send_string("OK")
-            await broadcast_update()
+        frames = await socket.recv_multipart()
+        trace = start_trace("zmq")
+        # REQ 封包: [identity, b"", payload, ...]; 多个 payload 帧为批量上报, 每帧一条 (JSON 或二进制)
+        split = frames.index(b"", 1) + 1 if b"" in frames[1:] else 1
+        envelope, payloads = frames[:split], frames[split:]
+        if len(payloads) == 1:
+            try:
+                data = decode_report(payloads[0])
+            except PayloadError as e:
+                record_ingest_error("zmq", e)
+                # 与批量格式一致回复被拒绝的帧序号; 旧版服务器只回复 ERROR, EA 据此区分
+                reply = b"ERROR UNSUPPORTED" if isinstance(e, UnsupportedBinaryVersion) else b"ERROR 0"
+                await socket.send_multipart(envelope + [reply])
+                continue
             
-        except Exception as e:
-            print(f"Error processing message: {e}")
-            await socket.send_string("ERROR")
+            if trace is not None:
+                trace.stage("decode")
+            await socket.send_multipart(envelope + [b"OK"])
+            INGEST_REPORTS.inc(labels=("zmq",))
+            enqueue_ingest(data, trace)
+            continue
+        
+        # 批量: 回复 OK, 或 "ERROR 1,3" 列出被拒绝的帧序号 (其余照常处理)
+        batch, rejected = [], []
+        for index, payload in enumerate(payloads):
+            try:
+                batch.append(decode_report(payload))
+            except PayloadError as e:
+                record_ingest_error("zmq", e)
+                rejected.append(str(index))
+        if trace is not None:
+            trace.stage("decode")
+        reply = b"ERROR " + ",".join(rejected).encode() if rejected else b"OK"
+        await socket.send_multipart(envelope + [reply])
+        if batch:
+            INGEST_REPORTS.inc(len(batch), ("zmq",))
+            enqueue_ingest(batch, trace)
 
-async def process_account_data(data: dict):
+async def process_account_data(data: AccountReport, trace: Optional[IngestTrace] = None):
     """处理接收到的账户数据"""
-    async with data_lock:
-        account_name = data['account_name']
+    await process_account_batch([data], trace)
+
+async def process_account_batch(reports: List[AccountReport], trace: Optional[IngestTrace] = None):
+    """一次加锁处理多条账户数据; history 合并为一个写入事务, 只唤醒一次广播"""
+    started = time.perf_counter()
+    rows = []
+    async with locked_accounts(data.account_name for data in reports):
+        if trace is not None:
+            trace.stage("lock")
+        for data in reports:
+            account_name = data.account_name
+            account = accounts.get(account_name)
+            if account is None:
+                account = AccountData(account_name)
+            
+            was_offline = account.status == "offline"
+            changed = account.update(data)
+            liveness.touch(account_name, data.update_interval)
+            if was_offline:
+                notify(account_name, "Back Online", "Account is reporting again", "info")
+            if trace is not None:
+                trace.stage("update")
+            evaluate_risk(account, changed)
+            if trace is not None:
+                trace.stage("risk")
+                trace.reports.append(account_name)
+            
+            accounts[account_name] = account
+            dirty_accounts.add(account_name)
+            # 在上报到达时编码完整记录, 把快照视图的编码开销分摊到各次上报, 而不是集中在广播时
+            account.to_json()
+            row = history_row(account)
+            if row is not None:
+                rows.append(row)
+        broadcast_event.set()
+        if trace is not None:
+            trace.processed(db_pending=bool(rows))
+    
+    if rows:
+        done = None
+        if trace is not None:
+            loop = asyncio.get_running_loop()
+            done = lambda: loop.call_soon_threadsafe(trace.committed, time.perf_counter())
+        db_writer.submit(lambda cursor: cursor.executemany(HISTORY_INSERT, rows), done)
+    PROCESS_SECONDS.observe(time.perf_counter() - started)
+
+def load_history_index():
+    """启动时用一次分组查询预热每个账户的最后记录时间"""
+    conn = sqlite3.connect(DB_PATH)
+    rows = conn.execute('''
+        SELECT account_name, MAX(timestamp) FROM history GROUP BY account_name
+    ''').fetchall()
+    conn.close()
+    history_last_saved.clear()
+    history_last_saved.update(rows)
+
+HISTORY_INSERT = '''
+    INSERT INTO history 
+    (account_name, timestamp, balance, equity, profit, today_pnl, total_pnl, best_day_ratio, profit_progress_pct, max_drawdown_pct)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+def history_row(account: AccountData) -> Optional[tuple]:
+    """需要写入 history 时返回一行参数 (距上次记录不足 HISTORY_SAVE_INTERVAL 秒则返回 None)"""
+    last_save = history_last_saved.get(account.account_name)
+    if last_save is not None and account.timestamp - last_save < HISTORY_SAVE_INTERVAL:
+        return None
+    history_last_saved[account.account_name] = account.timestamp
+    
+    return (account.account_name, account.timestamp, account.balance, account.equity, 
+            account.profit, account.today_pnl, account.total_pnl, account.best_day_ratio,
+            account.profit_progress_pct, account.max_drawdown_pct)
+
+def mark_dirty(account_name: str):
+    """标记账户已变化, 等待下一次合并广播"""
+    dirty_accounts.add(account_name)
+    broadcast_event.set()
+
+def build_patch(names: Iterable[str]) -> Optional[str]:
+    """把指定账户自上次广播以来变化的字段编码为一条 patch, 推进 ws_seq 并发布新的快照视图
+    
+    中间没有 await, 在事件循环内是原子的, 不需要加锁
+    """
+    global ws_seq, snapshot_view
+    changes = []
+    removed = []
+    for name in names:
+        acc = accounts.get(name)
+        if acc is None:
+            if account_fragments.pop(name, None) is not None:
+                removed.append(name)
+        elif acc.changed:
+            fragment = account_fragments[name] = acc.json_key + acc.to_json()
+            # 变化超过一半字段时直接发送完整记录 (值都是绝对值, 多发的字段无害), 省去一次编码
+            if len(acc.changed) * 2 >= len(ACCOUNT_FIELDS):
+                changes.append(fragment)
+            else:
+                changes.append(acc.json_key + acc.to_json(acc.changed))
+            acc.changed = set()
+    
+    if not changes and not removed:
+        return None
+    
+    ws_seq += 1
+    snapshot_view = SnapshotView(ws_seq, tuple(account_fragments.values()))
+    return '{"type":"patch","v":%d,"seq":%d,"changes":{%s},"removed":%s,"timestamp":"%s"}' % (
+        WS_PROTOCOL_VERSION, ws_seq, ",".join(changes), json_dumps(removed), datetime.now().isoformat()
+    )
+
+#--- WebSocket 客户端 ---
+class ClientConnection:
+    """单个 WebSocket 客户端: 有界发送队列 + 独立写任务
+    
+    队列满时丢弃积压的增量, 改为发送最新快照; 积压持续超过 WS_MAX_LAG 秒则断开。
+    队列项为 (入队时间, 消息), 消息为 None 表示"发送当前快照"。
+    """
+    
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_QUEUE_SIZE)
+        self.connected_at = time.monotonic()
+        self.pending_since: Optional[float] = None  # 最早未发送消息的入队时间
+        self.snapshot_pending = False
+        self.max_queue_depth = 0
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+        self.task: Optional[asyncio.Task] = None
+    
+    @property
+    def name(self) -> str:
+        client = self.websocket.client
+        return f"{client.host}:{client.port}" if client else "unknown"
+    
+    def start(self):
+        self.task = asyncio.create_task(self._writer())
+    
+    def enqueue(self, message: Optional[str]):
+        """非阻塞入队; message 为 None 表示请求快照"""
+        if self.closed:
+            return
         
-        # 保留之前的alert_sent状态
-        prev_alert_sent = accounts.get(account_name, AccountData(**data)).alert_sent if account_name in accounts else False
+        now = time.monotonic()
+        if self.pending_since is not None and now - self.pending_since > WS_MAX_LAG:
+            print(f"WebSocket client {self.name} lagging {now - self.pending_since:.0f}s, disconnecting")
+            self.close()
+            return
         
-        account = AccountData(
-            timestamp=data['timestamp'],
-            account_name=account_name,
-            account_type=data['account_type'],
-            prop_firm=data.get('prop_firm', ''),
-            login=data['login'],
-            company=data['company'],
-            server=data['server'],
-            currency=data['currency'],
-            is_cent=data['is_cent'],
-            is_ftmo_1step=data.get('is_ftmo_1step', False),
-            balance=data['balance'],
-            equity=data['equity'],
-            margin=data['margin'],
-            free_margin=data['free_margin'],
-            profit=data['profit'],
-            open_profit=data['open_profit'],
-            margin_level=data['margin_level'],
-            positions_count=data['positions_count'],
-            open_volume=data['open_volume'],
-            challenge_size=data['challenge_size'],
-            initial_balance=data.get('initial_balance', data['balance']),
-            highest_balance=data.get('highest_balance', data['balance']),
-            yesterday_balance=data.get('yesterday_balance', data['balance']),
-            daily_loss_limit=data.get('daily_loss_limit', 0),
-            daily_loss_remaining=data.get('daily_loss_remaining', 0),
-            total_loss_limit=data.get('total_loss_limit', 0),
-            total_loss_remaining=data.get('total_loss_remaining', 0),
-            profit_target_remaining=data.get('profit_target_remaining', 0),
-            profit_progress_pct=data.get('profit_progress_pct', 0),
-            best_day_profit=data.get('best_day_profit', 0),
-            best_day_ratio=data.get('best_day_ratio', 0),
-            best_day_remaining=data.get('best_day_remaining', 0),
-            best_day_passed=data.get('best_day_passed', False),
-            max_daily_loss_pct=data.get('max_daily_loss_pct', 5),
-            max_total_loss_pct=data.get('max_total_loss_pct', 10),
-            profit_target_pct=data.get('profit_target_pct', 10),
-            today_pnl=data.get('today_pnl', 0),
-            today_pnl_pct=data.get('today_pnl_pct', 0),
-            week_pnl=data.get('week_pnl', 0),
-            month_pnl=data.get('month_pnl', 0),
-            total_pnl=data.get('total_pnl', 0),
-            total_pnl_pct=data.get('total_pnl_pct', 0),
-            avg_daily_pnl=data.get('avg_daily_pnl', 0),
-            win_rate=data.get('win_rate', 0),
-            profitable_days=data.get('profitable_days', 0),
-            losing_days=data.get('losing_days', 0),
-            max_drawdown=data.get('max_drawdown', 0),
-            max_drawdown_pct=data.get('max_drawdown_pct', 0),
-            sharpe_ratio=data.get('sharpe_ratio', 0),
-            trading_days=data.get('trading_days', 0),
-            daily_loss_alert_pct=data.get('daily_loss_alert_pct', 5),
-            daily_profit_alert_pct=data.get('daily_profit_alert_pct', 0),
-            last_seen=datetime.now(),
-            status="online",
-            alert_sent=prev_alert_sent
-        )
+        if self.snapshot_pending:
+            # 已排队的快照会包含这条增量
+            self.dropped += 1
+            return
         
-        account = calculate_risk_status(account)
-        accounts[account_name] = account
-        save_to_history(account)
-
-async def process_account_data_http(data: dict):
-    """HTTP version - add timestamp if missing"""
-    if 'timestamp' not in data:
-        data['timestamp'] = int(datetime.now().timestamp())
-    await process_account_data(data)
-    await broadcast_update()
-
-def save_to_history(account: AccountData):
-    """保存账户历史数据"""
-    conn = sqlite3.connect('mt4_monitor.db')
-    cursor = conn.cursor()
+        if message is None:
+            self.snapshot_pending = True
+        
+        try:
+            self.queue.put_nowait((now, message))
+        except asyncio.QueueFull:
+            # 丢弃所有积压增量, 改为发送最新快照; 快照沿用最早被丢弃消息的入队时间, 积压时长不清零
+            oldest = now
+            while not self.queue.empty():
+                enqueued_at, _ = self.queue.get_nowait()
+                oldest = min(oldest, enqueued_at)
+                self.dropped += 1
+            if message is not None:
+                self.dropped += 1
+            self.snapshot_pending = True
+            self.queue.put_nowait((oldest, None))
+        
+        if self.pending_since is None:
+            self.pending_since = now
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
     
-    cursor.execute('''
-        SELECT timestamp FROM history 
-        WHERE account_name = ? 
-        ORDER BY timestamp DESC LIMIT 1
-    ''', (account.account_name,))
-    
-    result = cursor.fetchone()
-    should_save = True
-    
-    if result:
-        last_save = result[0]
-        if account.timestamp - last_save < 300:
-            should_save = False
-    
-    if should_save:
-        cursor.execute('''
-            INSERT INTO history 
-            (account_name, timestamp, balance, equity, profit, today_pnl, total_pnl, best_day_ratio, profit_progress_pct)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (account.account_name, account.timestamp, account.balance, account.equity, 
-              account.profit, account.today_pnl, account.total_pnl, account.best_day_ratio,
-              account.profit_progress_pct))
-        conn.commit()
+    async def _writer(self):
+        try:
+            while True:
+                self.pending_since, message = await self.queue.get()
+                if message is None:
+                    self.snapshot_pending = False
+                    message = snapshot_view.message()
+                started = time.perf_counter()
+                await asyncio.wait_for(self.websocket.send_text(message), timeout=WS_MAX_LAG)
+                WS_SEND_SECONDS.observe(time.perf_counter() - started)
+                self.sent += 1
+                if self.queue.empty():
+                    self.pending_since = None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"WebSocket client {self.name} send failed: {e!r}")
+            self.close()
     
-    conn.close()
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self in active_connections:
+            active_connections.remove(self)
+        if self.task and self.task is not asyncio.current_task():
+            self.task.cancel()
+        asyncio.create_task(self._close_socket())
+    
+    async def _close_socket(self):
+        try:
+            await self.websocket.close()
+        except Exception:
+            pass
+    
+    def stats(self) -> dict:
+        return {
+            "client": self.name,
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "lag_seconds": round(time.monotonic() - self.pending_since, 3) if self.pending_since is not None else 0,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "connected_seconds": round(time.monotonic() - self.connected_at, 1)
+        }
 
 async def broadcast_update():
-    """广播数据更新到所有WebSocket连接"""
-    if not active_connections:
+    """把所有脏账户合并为一条增量, 放入每个客户端的发送队列"""
+    names = list(dirty_accounts)
+    dirty_accounts.clear()
+    started = time.perf_counter()
+    message = build_patch(names)
+    built = time.perf_counter()
+    BROADCAST_BUILD_SECONDS.observe(built - started)
+    if traces_awaiting_broadcast:
+        # 等待中的上报都已在本次的 dirty_accounts 中
+        traces = traces_awaiting_broadcast[:]
+        traces_awaiting_broadcast.clear()
+        for trace in traces:
+            trace.broadcasted(built)
+    
+    if message is None or not active_connections:
         return
     
-    async with data_lock:
-        data = {name: acc.to_dict() for name, acc in accounts.items()}
+    for client in list(active_connections):
+        client.enqueue(message)
+
+async def broadcast_scheduler():
+    """后台广播任务: 合并写入期间的所有变更, 每秒最多推送 BROADCAST_HZ 次"""
+    interval = 1.0 / BROADCAST_HZ if BROADCAST_HZ > 0 else 0
+    while True:
+        await broadcast_event.wait()
+        broadcast_event.clear()
+        try:
+            await broadcast_update()
+        except Exception as e:
+            print(f"Broadcast error: {e}")
+        await asyncio.sleep(interval)
+
+#--- 在线检测 ---
+class LivenessTracker:
+    """按每个账户的离线期限维护最小堆, 期限一到立即标记离线
+    
+    期限 = 最后一次上报 + update_interval * OFFLINE_MISSED_REPORTS (EA 未上报间隔时用 OFFLINE_TIMEOUT)。
+    上报通常只更新 deadlines, 弹出时若期间收到过上报则按新期限重新入堆;
+    新期限早于已入堆的期限 (上报间隔变短) 时另外入堆, 旧项弹出时跳过。
+    """
     
-    message = json.dumps({
-        "type": "update",
-        "data": data,
-        "timestamp": datetime.now().isoformat()
-    })
+    def __init__(self):
+        self.deadlines: Dict[str, float] = {}  # 账户 -> 离线期限 (monotonic)
+        self.heap: List[tuple] = []
+        self.scheduled: Dict[str, float] = {}  # 账户 -> 堆中有效项的期限
+        self.wakeup = asyncio.Event()
     
-    disconnected = []
-    for connection in active_connections:
-        try:
-            await connection.send_text(message)
-        except:
-            disconnected.append(connection)
+    def touch(self, account_name: str, update_interval: int):
+        timeout = update_interval * OFFLINE_MISSED_REPORTS if update_interval > 0 else OFFLINE_TIMEOUT
+        deadline = time.monotonic() + timeout
+        self.deadlines[account_name] = deadline
+        queued = self.scheduled.get(account_name)
+        if queued is None or deadline < queued:
+            self.scheduled[account_name] = deadline
+            heapq.heappush(self.heap, (deadline, account_name))
+            if self.heap[0][1] == account_name:
+                self.wakeup.set()
+    
+    async def run(self):
+        while True:
+            if not self.heap:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            
+            deadline, account_name = self.heap[0]
+            now = time.monotonic()
+            if deadline > now:
+                # 睡到最早的期限, 期间有更早的期限入堆时提前醒来
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), deadline - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            heapq.heappop(self.heap)
+            if self.scheduled.get(account_name) != deadline:
+                continue  # 已被更早的期限取代
+            current = self.deadlines.get(account_name, deadline)
+            if current > now:
+                self.scheduled[account_name] = current
+                heapq.heappush(self.heap, (current, account_name))
+                continue
+            
+            del self.scheduled[account_name]
+            try:
+                mark_offline(account_name)
+            except Exception as e:
+                print(f"Liveness error: {e}")
+
+liveness = LivenessTracker()
+
+def mark_offline(account_name: str):
+    """在线 -> 离线: 只在状态变化时广播并发送告警"""
+    account = accounts.get(account_name)
+    if account is None or account.status == "offline":
+        return
+    account.set('status', "offline")
+    mark_dirty(account_name)
+    silent = (datetime.now() - account.last_seen).total_seconds()
+    notify(account_name, "Offline", f"No report for {silent:.0f}s", "warning")
+
+#--- 历史数据汇总 ---
+# history (约5分钟一条) -> history_1h -> history_1d; 汇总表与分桶查询返回相同字段
+HISTORY_TIERS = {"raw": 0, "1h": 3600, "1d": 86400}
+
+BUCKET_FIELDS = (
+    "timestamp", "count",
+    "equity_open", "equity_high", "equity_low", "equity_close",
+    "balance_open", "balance_high", "balance_low", "balance_close",
+    "today_pnl_low", "today_pnl_high", "today_pnl", "total_pnl", "drawdown_max"
+)
+
+def rollup_history(cursor: sqlite3.Cursor):
+    """写线程中执行: 增量刷新小时/日汇总并按保留期清理
+    
+    以 history.id 为进度: 只重算新行涉及的 (账户, 桶), 各账户时钟不同或迟到的行也能补齐;
+    返回 {账户: 重算的最早日桶}
+    """
+    now = int(time.time())
+    # 清理线按天对齐, 桶不会被拆开
+    raw_cutoff = (now - RAW_RETENTION_DAYS * 86400) // 86400 * 86400 if RAW_RETENTION_DAYS > 0 else 0
+    hourly_cutoff = (now - HOURLY_RETENTION_DAYS * 86400) // 86400 * 86400 if HOURLY_RETENTION_DAYS > 0 else 0
+    
+    cursor.execute('SELECT name, value FROM rollup_state')
+    state = dict(cursor.fetchall())
+    last_id = state.get('history_id', 0)
+    # 只有以前的运行已经清理过的桶数据不完整, 不再重算; 本轮才清理的桶先汇总再清理
+    raw_pruned = state.get('raw_pruned', 0)
+    hourly_pruned = state.get('hourly_pruned', 0)
+    cursor.execute('SELECT COALESCE(MAX(id), 0) FROM history')
+    max_id = cursor.fetchone()[0]
     
-    for conn in disconnected:
-        if conn in active_connections:
-            active_connections.remove(conn)
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS touched_1h (account_name TEXT, bucket INTEGER, PRIMARY KEY (account_name, bucket))')
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS touched_1d (account_name TEXT, bucket INTEGER, PRIMARY KEY (account_name, bucket))')
+    cursor.execute('DELETE FROM touched_1h')
+    cursor.execute('DELETE FROM touched_1d')
+    cursor.execute('''
+        INSERT OR IGNORE INTO touched_1h
+        SELECT account_name, timestamp / 3600 * 3600 FROM history
+        WHERE id > ? AND id <= ? AND timestamp >= ?
+    ''', (last_id, max_id, raw_pruned))
+    cursor.execute('''
+        INSERT OR IGNORE INTO touched_1d
+        SELECT account_name, bucket / 86400 * 86400 FROM touched_1h WHERE bucket >= ?
+    ''', (hourly_pruned,))
+    
+    cursor.execute('''
+        WITH b AS (
+            SELECT t.account_name, t.bucket, COUNT(*) AS n,
+                   MIN(h.timestamp) AS first_ts, MAX(h.timestamp) AS last_ts,
+                   MAX(h.equity) AS equity_high, MIN(h.equity) AS equity_low,
+                   MAX(h.balance) AS balance_high, MIN(h.balance) AS balance_low,
+                   MIN(h.today_pnl) AS today_pnl_low, MAX(h.today_pnl) AS today_pnl_high,
+                   MAX(h.max_drawdown_pct) AS drawdown_max
+            FROM touched_1h t
+            JOIN history h ON h.account_name = t.account_name
+                          AND h.timestamp >= t.bucket AND h.timestamp < t.bucket + 3600
+            GROUP BY t.account_name, t.bucket
+        )
+        INSERT OR REPLACE INTO history_1h
+        SELECT b.account_name, b.bucket, b.n,
+               o.equity, b.equity_high, b.equity_low, c.equity,
+               o.balance, b.balance_high, b.balance_low, c.balance,
+               b.today_pnl_low, b.today_pnl_high, c.today_pnl, c.total_pnl, b.drawdown_max
+        FROM b
+        JOIN history o ON o.id = (SELECT id FROM history
+                                  WHERE account_name = b.account_name AND timestamp = b.first_ts LIMIT 1)
+        JOIN history c ON c.id = (SELECT id FROM history
+                                  WHERE account_name = b.account_name AND timestamp = b.last_ts LIMIT 1)
+    ''')
+    
+    cursor.execute('''
+        WITH b AS (
+            SELECT t.account_name, t.bucket AS day, SUM(h.count) AS n,
+                   MIN(h.bucket) AS first_bucket, MAX(h.bucket) AS last_bucket,
+                   MAX(h.equity_high) AS equity_high, MIN(h.equity_low) AS equity_low,
+                   MAX(h.balance_high) AS balance_high, MIN(h.balance_low) AS balance_low,
+                   MIN(h.today_pnl_low) AS today_pnl_low, MAX(h.today_pnl_high) AS today_pnl_high,
+                   MAX(h.drawdown_max) AS drawdown_max
+            FROM touched_1d t
+            JOIN history_1h h ON h.account_name = t.account_name
+                             AND h.bucket >= t.bucket AND h.bucket < t.bucket + 86400
+            GROUP BY t.account_name, t.bucket
+        )
+        INSERT OR REPLACE INTO history_1d
+        SELECT b.account_name, b.day, b.n,
+               o.equity_open, b.equity_high, b.equity_low, c.equity_close,
+               o.balance_open, b.balance_high, b.balance_low, c.balance_close,
+               b.today_pnl_low, b.today_pnl_high, c.today_pnl, c.total_pnl, b.drawdown_max
+        FROM b
+        JOIN history_1h o ON o.account_name = b.account_name AND o.bucket = b.first_bucket
+        JOIN history_1h c ON c.account_name = b.account_name AND c.bucket = b.last_bucket
+    ''')
+    cursor.execute("INSERT OR REPLACE INTO rollup_state (name, value) VALUES ('history_id', ?)", (max_id,))
+    cursor.execute('SELECT account_name, MIN(bucket) FROM touched_1d GROUP BY account_name')
+    touched = dict(cursor.fetchall())
+    
+    # 只清理已经汇总过的行 (id <= 进度), 与各账户的时钟无关
+    if RAW_RETENTION_DAYS > 0:
+        cursor.execute('DELETE FROM history WHERE timestamp < ? AND id <= ?', (raw_cutoff, max_id))
+        cursor.execute("INSERT OR REPLACE INTO rollup_state (name, value) VALUES ('raw_pruned', ?)",
+                       (max(raw_pruned, raw_cutoff),))
+    if HOURLY_RETENTION_DAYS > 0:
+        # 本轮涉及的小时桶已经写入 history_1d
+        cursor.execute('DELETE FROM history_1h WHERE bucket < ?', (hourly_cutoff,))
+        cursor.execute("INSERT OR REPLACE INTO rollup_state (name, value) VALUES ('hourly_pruned', ?)",
+                       (max(hourly_pruned, hourly_cutoff),))
+    return touched
 
-async def check_offline_accounts():
-    """定期检查账户是否离线"""
+async def rollup_worker():
+    """后台汇总任务"""
     while True:
-        await asyncio.sleep(30)
-        
-        async with data_lock:
-            now = datetime.now()
-            for account in accounts.values():
-                if account.last_seen and (now - account.last_seen).seconds > 60:
-                    account.status = "offline"
+        touched = {}
+        # 提交后再丢弃缓存, 否则读线程可能又缓存到旧数据
+        db_writer.submit(lambda cursor: touched.update(rollup_history(cursor)),
+                         lambda: invalidate_daily_series(touched))
+        await asyncio.sleep(ROLLUP_INTERVAL)
+
+def pick_history_tier(since: int, resolution: int) -> str:
+    """选择能满足桶宽和时间范围的最粗 (最便宜) 层级"""
+    now = int(time.time())
+    raw_covers = RAW_RETENTION_DAYS <= 0 or since >= now - RAW_RETENTION_DAYS * 86400
+    hourly_covers = HOURLY_RETENTION_DAYS <= 0 or since >= now - HOURLY_RETENTION_DAYS * 86400
+    if resolution >= HISTORY_TIERS["1d"] or not hourly_covers:
+        return "1d"
+    if resolution >= HISTORY_TIERS["1h"] or not raw_covers:
+        return "1h"
+    return "raw"
+
+def query_history_buckets(cursor: sqlite3.Cursor, account_name: str, since: int, resolution: int) -> List[dict]:
+    """按 resolution 秒分桶, 在 SQL 中聚合 equity/balance 的 OHLC"""
+    cursor.execute('''
+        WITH buckets AS (
+            SELECT timestamp / :res AS bucket,
+                   MIN(timestamp) AS first_ts, MAX(timestamp) AS last_ts, COUNT(*) AS n,
+                   MAX(equity) AS equity_high, MIN(equity) AS equity_low,
+                   MAX(balance) AS balance_high, MIN(balance) AS balance_low,
+                   MIN(today_pnl) AS today_pnl_low, MAX(today_pnl) AS today_pnl_high,
+                   MAX(max_drawdown_pct) AS drawdown_max
+            FROM history
+            WHERE account_name = :account AND timestamp > :since
+            GROUP BY bucket
+        )
+        SELECT b.bucket * :res, b.n,
+               o.equity, b.equity_high, b.equity_low, c.equity,
+               o.balance, b.balance_high, b.balance_low, c.balance,
+               b.today_pnl_low, b.today_pnl_high, c.today_pnl, c.total_pnl, b.drawdown_max
+        FROM buckets b
+        JOIN history o ON o.id = (SELECT id FROM history
+                                  WHERE account_name = :account AND timestamp = b.first_ts LIMIT 1)
+        JOIN history c ON c.id = (SELECT id FROM history
+                                  WHERE account_name = :account AND timestamp = b.last_ts LIMIT 1)
+        ORDER BY b.bucket
+    ''', {"res": resolution, "account": account_name, "since": since})
+    
+    return [dict(zip(BUCKET_FIELDS, r)) for r in cursor.fetchall()]
+
+def query_rollup_buckets(cursor: sqlite3.Cursor, tier: str, account_name: str, since: int, resolution: int) -> List[dict]:
+    """从汇总表读取, 再按 resolution 合并为更宽的桶
+    
+    汇总最多落后 ROLLUP_INTERVAL: 从该账户最后一个 (可能不完整的) 汇总桶起改用原始 history
+    """
+    table = {"1h": "history_1h", "1d": "history_1d"}[tier]
+    resolution = max(resolution, HISTORY_TIERS[tier])
+    cursor.execute(f'SELECT MAX(bucket) FROM {table} WHERE account_name = ?', (account_name,))
+    last = cursor.fetchone()[0]
+    tail = since if last is None else last - last % resolution
+    if RAW_RETENTION_DAYS > 0:
+        # 已清理的原始数据只能用汇总
+        oldest_raw = int(time.time()) - RAW_RETENTION_DAYS * 86400
+        tail = max(tail, oldest_raw - oldest_raw % resolution + resolution)
+    cursor.execute(f'''
+        WITH buckets AS (
+            SELECT bucket / :res AS g, MIN(bucket) AS first_bucket, MAX(bucket) AS last_bucket,
+                   SUM(count) AS n,
+                   MAX(equity_high) AS equity_high, MIN(equity_low) AS equity_low,
+                   MAX(balance_high) AS balance_high, MIN(balance_low) AS balance_low,
+                   MIN(today_pnl_low) AS today_pnl_low, MAX(today_pnl_high) AS today_pnl_high,
+                   MAX(drawdown_max) AS drawdown_max
+            FROM {table}
+            WHERE account_name = :account AND bucket >= :since AND bucket < :tail
+            GROUP BY g
+        )
+        SELECT b.g * :res, b.n,
+               o.equity_open, b.equity_high, b.equity_low, c.equity_close,
+               o.balance_open, b.balance_high, b.balance_low, c.balance_close,
+               b.today_pnl_low, b.today_pnl_high, c.today_pnl, c.total_pnl, b.drawdown_max
+        FROM buckets b
+        JOIN {table} o ON o.account_name = :account AND o.bucket = b.first_bucket
+        JOIN {table} c ON c.account_name = :account AND c.bucket = b.last_bucket
+        ORDER BY b.g
+    ''', {"res": resolution, "account": account_name, "since": since - since % HISTORY_TIERS[tier], "tail": tail})
+    
+    rows = [dict(zip(BUCKET_FIELDS, r)) for r in cursor.fetchall()]
+    return rows + query_history_buckets(cursor, account_name, max(since, tail - 1), resolution)
+
+def lttb(points: List[dict], threshold: int, x: str = "timestamp", y: str = "equity") -> List[dict]:
+    """Largest-Triangle-Three-Buckets 降采样, 保留曲线形状, 返回原始点的子集"""
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return points
+    
+    sampled = [points[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # 下一个桶的平均点
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        span = next_end - next_start
+        avg_x = sum(points[j][x] for j in range(next_start, next_end)) / span
+        avg_y = sum(points[j][y] for j in range(next_start, next_end)) / span
         
-        await broadcast_update()
+        # 当前桶中与上一选中点、下一桶平均点组成最大三角形的点
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        ax, ay = points[a][x], points[a][y]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (points[j][y] - ay) - (ax - points[j][x]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    
+    sampled.append(points[-1])
+    return sampled
+
+def query_account_history(cursor: sqlite3.Cursor, account_name: str, hours: int, resolution: Optional[int],
+                          max_points: Optional[int], method: str) -> List[dict]:
+    """/api/accounts/{name}/history 的查询部分, 在只读连接池中执行"""
+    since = int((datetime.now() - timedelta(hours=hours)).timestamp())
+
+    if method == "bucket" and (resolution or max_points):
+        if resolution is None:
+            # 桶按整数倍对齐, 窗口两端可能各占半个桶, 因此按 max_points - 1 划分
+            resolution = max(1, -(-hours * 3600 // (max_points - 1)))
+        tier = pick_history_tier(since, resolution)
+        if tier == "raw":
+            return query_history_buckets(cursor, account_name, since, resolution)
+        return query_rollup_buckets(cursor, tier, account_name, since, resolution)
+
+    cursor.execute('''
+        SELECT timestamp, balance, equity, profit, today_pnl, total_pnl, best_day_ratio, profit_progress_pct
+        FROM history
+        WHERE account_name = ? AND timestamp > ?
+        ORDER BY timestamp
+    ''', (account_name, since))
+
+    points = [
+        {
+            "timestamp": r[0], "balance": r[1], "equity": r[2], "profit": r[3],
+            "today_pnl": r[4], "total_pnl": r[5],
+            "best_day_ratio": r[6], "profit_progress_pct": r[7]
+        }
+        for r in cursor.fetchall()
+    ]
+    if method == "lttb":
+        points = lttb(points, max_points)
+    return points
+
+#--- 绩效统计 ---
+# 由 history 按 UTC 日计算, 不依赖 EA 自报的统计 (EA 重启后会清零); 需要 numpy
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DAILY_COLUMNS = ("day", "equity_open", "equity_high", "equity_low", "equity_close")
+TRADING_DAYS_PER_YEAR = 252
+
+class DailySeries:
+    """一个账户的日线缓存
+
+    history_1d 中早于该账户汇总水位 (它最新的日桶) 的日子缓存后只追加;
+    水位当天及之后的日子每次从原始 history 现算。迟到的上报使汇总重算较早的日子时,
+    由 invalidate_daily_series 丢弃那之后的缓存。
+    """
+
+    __slots__ = ('days', 'until')
+
+    def __init__(self):
+        self.days = np.empty((0, len(DAILY_COLUMNS)))
+        self.until = 0  # 已缓存到 (不含) 的日桶
+
+daily_series: Dict[str, DailySeries] = {}
+daily_series_lock = threading.Lock()  # 查询在只读连接池的多个线程中执行
+
+def load_daily(cursor: sqlite3.Cursor, account_name: str):
+    """返回账户全部日线 (按日排序的 ndarray, 列为 DAILY_COLUMNS)"""
+    # 各账户时钟不同, 水位按账户取
+    cursor.execute('SELECT COALESCE(MAX(bucket), 0) FROM history_1d WHERE account_name = ?', (account_name,))
+    watermark = cursor.fetchone()[0]
+
+    with daily_series_lock:
+        series = daily_series.get(account_name)
+        if series is None:
+            series = daily_series[account_name] = DailySeries()
+        if watermark > series.until:
+            cursor.execute('''
+                SELECT bucket, equity_open, equity_high, equity_low, equity_close FROM history_1d
+                WHERE account_name = ? AND bucket >= ? AND bucket < ?
+                ORDER BY bucket
+            ''', (account_name, series.until, watermark))
+            rows = cursor.fetchall()
+            if rows:
+                series.days = np.concatenate((series.days, np.array(rows, dtype=float)))
+            series.until = watermark
+        days, until = series.days, series.until
+
+    recent = [
+        (b["timestamp"], b["equity_open"], b["equity_high"], b["equity_low"], b["equity_close"])
+        for b in query_history_buckets(cursor, account_name, until - 1, 86400)
+    ]
+    if not recent:
+        return days
+    return np.concatenate((days, np.array(recent, dtype=float)))
+
+def invalidate_daily_series(touched: Dict[str, int]):
+    """汇总提交后调用: 丢弃 {账户: 最早重算日桶} 及之后的缓存日线"""
+    with daily_series_lock:
+        for account_name, day in touched.items():
+            series = daily_series.get(account_name)
+            if series is not None and day < series.until:
+                series.days = series.days[series.days[:, 0] < day]
+                series.until = day
+
+def compute_stats(days) -> dict:
+    """日线 -> 胜率/日均盈亏/最大回撤/夏普比率, 字段名与 EA 上报的统计一致"""
+    if len(days) == 0:
+        return {
+            "trading_days": 0, "profitable_days": 0, "losing_days": 0, "win_rate": 0,
+            "total_pnl": 0, "avg_daily_pnl": 0, "max_drawdown": 0, "max_drawdown_pct": 0,
+            "sharpe_ratio": None,
+        }
+    opens, highs, lows, closes = days[:, 1], days[:, 2], days[:, 3], days[:, 4]
+
+    # 每日盈亏 = 当日收盘 - 前一日收盘 (第一天相对当日开盘)
+    previous = np.concatenate((opens[:1], closes[:-1]))
+    pnl = closes - previous
+    profitable = int(np.count_nonzero(pnl > 0))
+    losing = int(np.count_nonzero(pnl < 0))
+
+    # 回撤: 此前最高点 (含当日开盘) 到当日最低点; 日内高低点的先后未知, 不用当日最高点
+    peaks = np.maximum(np.concatenate((opens[:1], np.maximum.accumulate(highs)[:-1])), opens)
+    drawdown = peaks - lows
+    with np.errstate(divide="ignore", invalid="ignore"):
+        drawdown_pct = np.where(peaks > 0, drawdown / peaks * 100, 0)
+        returns = np.where(previous > 0, pnl / previous, 0)
+
+    sharpe = None
+    if len(returns) > 1:
+        std = returns.std(ddof=1)
+        if std > 0:
+            sharpe = round(float(returns.mean() / std * math.sqrt(TRADING_DAYS_PER_YEAR)), 4)
+
+    return {
+        "trading_days": len(days),
+        "profitable_days": profitable,
+        "losing_days": losing,
+        "win_rate": round(profitable / (profitable + losing) * 100, 2) if profitable + losing else 0,
+        "total_pnl": round(float(pnl.sum()), 2),
+        "avg_daily_pnl": round(float(pnl.mean()), 2),
+        "max_drawdown": round(float(max(drawdown.max(), 0)), 2),
+        "max_drawdown_pct": round(float(max(drawdown_pct.max(), 0)), 4),
+        "sharpe_ratio": sharpe,
+    }
+
+def account_stats(cursor: sqlite3.Cursor, account_name: str, start: Optional[int], end: Optional[int]) -> dict:
+    """[start, end] 内 (按日对齐) 的统计"""
+    days = load_daily(cursor, account_name)
+    first = 0 if start is None else start - start % 86400
+    last = math.inf if end is None else end
+    window = days[(days[:, 0] >= first) & (days[:, 0] <= last)]
+    stats = compute_stats(window)
+    stats["account_name"] = account_name
+    stats["start"] = int(window[0, 0]) if len(window) else None
+    stats["end"] = int(window[-1, 0]) if len(window) else None
+    return stats
+
+#--- 历史数据导出 ---
+EXPORT_COLUMNS = (
+    "account_name", "timestamp", "balance", "equity", "profit", "today_pnl",
+    "total_pnl", "best_day_ratio", "profit_progress_pct", "max_drawdown_pct"
+)
+EXPORT_CHUNK_ROWS = 1000
+
+def parse_export_cursor(cursor: Optional[str]) -> tuple:
+    """cursor 格式为 "timestamp:id", 取自上一次导出最后一行的 cursor 列"""
+    if not cursor:
+        return (-1, -1)
+    try:
+        timestamp, row_id = cursor.split(":")
+        return (int(timestamp), int(row_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="cursor must be 'timestamp:id'")
+
+def iter_history_export(cursor: sqlite3.Cursor, account_names: Optional[List[str]], start: Optional[int],
+                        end: Optional[int], after: tuple, limit: Optional[int], fmt: str):
+    """按 (timestamp, id) 键集顺序流式输出, 内存占用与范围无关"""
+    where = ["(timestamp, id) > (?, ?)"]
+    params: list = list(after)
+    if account_names:
+        where.append(f"account_name IN ({','.join('?' * len(account_names))})")
+        params.extend(account_names)
+    if start is not None:
+        where.append("timestamp >= ?")
+        params.append(start)
+    if end is not None:
+        where.append("timestamp < ?")
+        params.append(end)
+    # 索引扫描顺序即输出顺序, 不需要临时排序表; 多个账户时按账户索引会先排序整个范围
+    index = "idx_history_account_ts" if account_names and len(account_names) == 1 else "idx_history_ts"
+    sql = f'''
+        SELECT id, {", ".join(EXPORT_COLUMNS)}
+        FROM history INDEXED BY {index}
+        WHERE {" AND ".join(where)}
+        ORDER BY timestamp, id
+    '''
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    
+    cursor.execute(sql, params)
+    if fmt == "csv":
+        yield ",".join(("cursor",) + EXPORT_COLUMNS) + "\r\n"
+    
+    while True:
+        rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+        if not rows:
+            break
+        buffer = io.StringIO()
+        if fmt == "csv":
+            writer = csv.writer(buffer)
+            for r in rows:
+                writer.writerow((f"{r[2]}:{r[0]}",) + r[1:])
+        else:
+            for r in rows:
+                record = dict(zip(EXPORT_COLUMNS, r[1:]))
+                record["cursor"] = f"{r[2]}:{r[0]}"
+                buffer.write(json_dumps(record))
+                buffer.write("\n")
+        yield buffer.getvalue()
 
 #--- FastAPI 应用 ---
 app = FastAPI(title="MT4/5 Account Monitor - Full Edition")
@@ -545,12 +2528,25 @@ app = FastAPI(title="MT4/5 Account Monitor - Full Edition")
 @app.on_event("startup")
 async def startup():
     init_database()
+    load_history_index()
+    db_writer.start()
     asyncio.create_task(zmq_receiver())
-    asyncio.create_task(check_offline_accounts())
-    asyncio.create_task(notification_worker())
+    for shard in ingest_queues:
+        asyncio.create_task(ingest_worker(shard))
+    asyncio.create_task(liveness.run())
+    asyncio.create_task(notification_dispatcher.run())
+    asyncio.create_task(broadcast_scheduler())
+    asyncio.create_task(rollup_worker())
+    if LOOP_LAG_MS > 0:
+        asyncio.create_task(loop_watchdog.run())
     print(f"Server started. Auth: {'enabled' if ENABLE_AUTH else 'disabled'}")
+    print(f"JSON codec: {json_codec}")
     print(f"Telegram notifications: {'enabled' if TELEGRAM_ENABLED else 'disabled'}")
 
+@app.on_event("shutdown")
+async def shutdown():
+    await asyncio.get_running_loop().run_in_executor(None, db_writer.stop)
+
 @app.get("/", response_class=HTMLResponse)
 async def dashboard():
     """Dashboard - no auth required for Cloudflare tunnel compatibility"""
@@ -559,70 +2555,235 @@ async def dashboard():
 @app.get("/api/accounts")
 async def get_accounts():
     """Get all accounts - no auth required for Cloudflare tunnel compatibility"""
-    async with data_lock:
-        return {name: acc.to_dict() for name, acc in accounts.items()}
+    # 与 WebSocket 推送同一份快照视图, 最多滞后 1/BROADCAST_HZ 秒
+    return Response(content=snapshot_view.accounts_json(), media_type="application/json")
 
 @app.post("/api/data")
 async def receive_data(request: Request):
     """HTTP endpoint for simplified EA (no ZMQ required, no auth)"""
+    body = await request.body()
+    trace = start_trace("http")
+    try:
+        data = decode_report(body)
+    except PayloadError as e:
+        record_ingest_error("http", e)
+        return JSONResponse(status_code=400, content={"status": "error", "detail": str(e)})
+    
+    if trace is not None:
+        trace.stage("decode")
+    INGEST_REPORTS.inc(labels=("http",))
     try:
-        body = await request.body()
-        body_str = body.decode().strip().split('\x00')[0]
-        data = json.loads(body_str)
-        await process_account_data_http(data)
-        await broadcast_update()
-        return {"status": "ok"}
+        await process_account_data(data, trace)
     except Exception as e:
         print(f"Error: {e}")
-        return {"status": "ok"}
+    # HTTP EA 只在看到 format 后才改发二进制; 旧服务器只回 {"status": "ok"}
+    return {"status": "ok", "format": "binary"}
+
+@app.post("/api/data/batch")
+async def receive_data_batch(request: Request):
+    """Batch endpoint for relays / multi-terminal VPS: JSON array of reports (no auth)"""
+    body = await request.body()
+    trace = start_trace("http")
+    try:
+        results = decode_report_batch(body)
+    except PayloadError as e:
+        record_ingest_error("http", e)
+        return JSONResponse(status_code=400, content={"status": "error", "detail": str(e)})
+    
+    reports, errors = [], []
+    for index, result in enumerate(results):
+        if isinstance(result, PayloadError):
+            record_ingest_error("http", result)
+            errors.append({"index": index, "detail": str(result)})
+        else:
+            reports.append(result)
+    
+    if trace is not None:
+        trace.stage("decode")
+    if reports:
+        INGEST_REPORTS.inc(len(reports), ("http",))
+        try:
+            await process_account_batch(reports, trace)
+        except Exception as e:
+            print(f"Error: {e}")
+    return {"status": "ok", "accepted": len(reports), "errors": errors}
+
+@app.get("/metrics")
+async def metrics(credentials: HTTPBasicCredentials = Depends(verify_credentials)):
+    """Prometheus 文本格式的运行指标"""
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # Health check endpoint
 @app.get("/health")
 async def health():
-    return {"status": "ok", "accounts": len(accounts)}
+    return {
+        "status": "ok",
+        "accounts": len(accounts),
+        "ws_clients": len(active_connections),
+        "ingest_errors": ingest_errors,
+        "ingest_dropped": ingest_dropped
+    }
+
+@app.get("/api/ingest/errors")
+async def get_ingest_errors(credentials: HTTPBasicCredentials = Depends(verify_credentials)):
+    """最近被拒绝的 EA 数据及原因"""
+    return list(recent_ingest_errors)
+
+@app.get("/api/ws/clients")
+async def get_ws_clients(credentials: HTTPBasicCredentials = Depends(verify_credentials)):
+    """每个 WebSocket 客户端的发送队列状态"""
+    return [client.stats() for client in active_connections]
+
+@app.get("/api/ingest/slow")
+async def get_slow_ingest(credentials: HTTPBasicCredentials = Depends(verify_credentials)):
+    """最近超过 MT4_SLOW_INGEST_MS 的上报及各阶段耗时"""
+    return list(slow_ingest_traces)
+
+@app.post("/api/profile/start")
+async def start_profile(
+    seconds: float = 30,
+    interval_ms: float = 10,
+    all_threads: bool = False,
+    credentials: HTTPBasicCredentials = Depends(verify_credentials)
+):
+    """启动采样分析器, 最多运行 seconds 秒; 默认只采样事件循环线程"""
+    global profiler
+    if profiler is not None and not profiler.stopped.is_set():
+        raise HTTPException(status_code=409, detail="profiler is already running")
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {PROFILE_MAX_SECONDS}]")
+    if interval_ms < 1:
+        raise HTTPException(status_code=400, detail="interval_ms must be at least 1")
+
+    profiler = SamplingProfiler(seconds, interval_ms / 1000, None if all_threads else threading.get_ident())
+    profiler.start()
+    return {"status": "started", "seconds": seconds, "interval_ms": interval_ms, "all_threads": all_threads}
+
+@app.post("/api/profile/stop")
+async def stop_profile(credentials: HTTPBasicCredentials = Depends(verify_credentials)):
+    """停止采样 (时间到后也可调用) 并返回折叠栈: 每行 "帧;帧;... 次数" """
+    global profiler
+    if profiler is None:
+        raise HTTPException(status_code=404, detail="profiler was not started")
+    current, profiler = profiler, None
+    collapsed = await asyncio.get_running_loop().run_in_executor(None, current.stop)
+    return Response(content=collapsed, media_type="text/plain", headers={
+        "X-Profile-Samples": str(current.samples),
+        "X-Profile-Seconds": f"{time.monotonic() - current.started_at:.1f}",
+    })
 
 @app.get("/api/accounts/{account_name}/history")
-async def get_account_history(account_name: str, hours: int = 24, credentials: HTTPBasicCredentials = Depends(verify_credentials)):
-    conn = sqlite3.connect('mt4_monitor.db')
-    cursor = conn.cursor()
+async def get_account_history(
+    account_name: str,
+    hours: int = 24,
+    resolution: Optional[int] = None,
+    max_points: Optional[int] = None,
+    method: str = "bucket",
+    credentials: HTTPBasicCredentials = Depends(verify_credentials)
+):
+    """账户历史; 指定 resolution (秒) 或 max_points 时返回降采样结果
     
-    since = int((datetime.now() - timedelta(hours=hours)).timestamp())
+    method=bucket: 按时间分桶的 OHLC 聚合, 自动从 history/history_1h/history_1d 中选最便宜的层级;
+    method=lttb: 对原始记录做 LTTB 选点, 保留原始字段
+    """
+    if method not in ("bucket", "lttb"):
+        raise HTTPException(status_code=400, detail="method must be 'bucket' or 'lttb'")
+    if resolution is not None and resolution <= 0:
+        raise HTTPException(status_code=400, detail="resolution must be positive")
+    if max_points is not None and max_points < 3:
+        raise HTTPException(status_code=400, detail="max_points must be at least 3")
+    if method == "lttb" and max_points is None:
+        raise HTTPException(status_code=400, detail="method=lttb requires max_points")
     
-    cursor.execute('''
-        SELECT timestamp, balance, equity, profit, today_pnl, total_pnl, best_day_ratio, profit_progress_pct
-        FROM history 
-        WHERE account_name = ? AND timestamp > ?
-        ORDER BY timestamp
-    ''', (account_name, since))
+    # 大范围的原始记录可能有数万个点, JSON 编码也放在查询线程中完成
+    body = await read_pool.run(
+        lambda cursor: json_dumps(query_account_history(cursor, account_name, hours, resolution, max_points, method))
+    )
+    return Response(content=body, media_type="application/json")
+
+@app.get("/api/accounts/{account_name}/stats")
+async def get_account_stats(
+    account_name: str,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    credentials: HTTPBasicCredentials = Depends(verify_credentials)
+):
+    """由服务器保存的历史计算胜率/日均盈亏/最大回撤/夏普比率
+
+    start/end 为 Unix 时间戳 (按 UTC 日对齐), 缺省为全部历史
+    """
+    if np is None:
+        raise HTTPException(status_code=503, detail="numpy is required for server-side stats")
+    if start is not None and end is not None and start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+
+    return await read_pool.run(account_stats, account_name, start, end)
+
+@app.get("/api/history/export")
+async def export_history(
+    accounts: Optional[str] = None,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    format: str = "csv",
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    credentials: HTTPBasicCredentials = Depends(verify_credentials)
+):
+    """流式导出原始 history (CSV/NDJSON)
     
-    rows = cursor.fetchall()
-    conn.close()
+    accounts 为逗号分隔的账户名 (缺省为全部), start/end 为 Unix 时间戳;
+    每行带 cursor 列, 中断后把最后收到的 cursor 传回即可续传。
+    只导出原始 history: 开启 MT4_RAW_RETENTION_DAYS 时, 范围必须在保留期内, 更早的数据用 /api/history 的汇总。
+    """
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be 'csv' or 'ndjson'")
+    if limit is not None and limit <= 0:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    after = parse_export_cursor(cursor)
+    if RAW_RETENTION_DAYS > 0:
+        # 不静默截断: 早于保留期的原始数据可能已被清理
+        oldest = int(time.time()) - RAW_RETENTION_DAYS * 86400
+        if max(start or 0, after[0]) < oldest:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Raw history older than {RAW_RETENTION_DAYS} days is pruned; pass start >= {oldest} "
+                       f"or use /api/history for rollups"
+            )
+    account_names = [name for name in accounts.split(",") if name] if accounts else None
     
-    return [
-        {
-            "timestamp": r[0], "balance": r[1], "equity": r[2], "profit": r[3],
-            "today_pnl": r[4], "total_pnl": r[5],
-            "best_day_ratio": r[6], "profit_progress_pct": r[7]
-        }
-        for r in rows
-    ]
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    filename = f"mt4_history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{format}"
+    # 与历史/统计查询共用只读连接池的并发名额和超时
+    chunks = await read_pool.stream(iter_history_export, account_names, start, end, after, limit, format)
+    return StreamingResponse(
+        chunks,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket - no auth required for Cloudflare tunnel compatibility"""
     await websocket.accept()
-    active_connections.append(websocket)
+    client = ClientConnection(websocket)
     
     try:
-        async with data_lock:
-            data = {name: acc.to_dict() for name, acc in accounts.items()}
-        await websocket.send_text(json.dumps({"type": "init", "data": data}))
+        active_connections.append(client)
+        client.enqueue(snapshot_view.message())
+        client.start()
         
         while True:
-            await websocket.receive_text()
-    except WebSocketDisconnect:
-        if websocket in active_connections:
-            active_connections.remove(websocket)
+            text = await websocket.receive_text()
+            try:
+                request = json.loads(text)
+            except ValueError:
+                continue
+            if isinstance(request, dict) and request.get("type") == "resync":
+                client.enqueue(None)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        client.close()
 
 def get_dashboard_html():
     return '''<!DOCTYPE html>
@@ -880,7 +3041,27 @@ def get_dashboard_html():
     </div>
     
     <script>
-        let ws, accounts = {}, currentFilter = 'all';
+        let ws, accounts = {}, seq = null, resyncPending = false, currentFilter = 'all';
+        
+        function requestResync() {
+            if (resyncPending || !ws || ws.readyState !== WebSocket.OPEN) return;
+            resyncPending = true;
+            ws.send(JSON.stringify({type: 'resync'}));
+        }
+        
+        function applyPatch(msg) {
+            if (seq === null || msg.seq <= seq) return;
+            if (msg.seq !== seq + 1) {
+                requestResync();
+                return;
+            }
+            for (const [name, fields] of Object.entries(msg.changes)) {
+                accounts[name] = Object.assign(accounts[name] || {}, fields);
+            }
+            (msg.removed || []).forEach(name => delete accounts[name]);
+            seq = msg.seq;
+            render();
+        }
         
         function connect() {
             const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
@@ -892,6 +3073,8 @@ def get_dashboard_html():
             };
             
             ws.onclose = () => {
+                seq = null;
+                resyncPending = false;
                 document.getElementById('connStatus').className = 'connection-status disconnected';
                 document.getElementById('connStatus').textContent = 'Disconnected';
                 setTimeout(connect, 3000);
@@ -899,9 +3082,13 @@ def get_dashboard_html():
             
             ws.onmessage = (event) => {
                 const msg = JSON.parse(event.data);
-                if (msg.type === 'init' || msg.type === 'update') {
+                if (msg.type === 'init') {
                     accounts = msg.data;
+                    seq = msg.seq;
+                    resyncPending = false;
                     render();
+                } else if (msg.type === 'patch') {
+                    applyPatch(msg);
                 }
             };
         }